@@ -1,174 +1,1087 @@
 # SQLiteState.py
 import sqlite3
+import re
 import json
 import uuid
+import zlib
+import queue
+import copy
+import time
+import atexit
 import threading
+from collections import OrderedDict
+from contextlib import contextmanager
 from datetime import datetime
 from pathlib import Path
 
+from metrics import metrics
+
+
+# Row shapes returned for content and sessions, matching the dicts these used to be stored as
+CONTENT_COLUMNS = 'id, user_id AS user, filename, type, preview, length, created_at AS created'
+SESSION_COLUMNS = '''id, user_id AS user, subject, started_at AS start, ended_at AS "end",
+                     activity_count, ai_calls, tokens'''
+
+# Seconds each kind of small, hot read may be served from memory. Keys are prefixes of
+# `get` keys, plus "users:" for profile rows; anything else always reads SQLite.
+CACHE_POLICIES = {"current_session:": 300.0, "users:": 60.0}
+
 
 class SQLiteState:
-    def __init__(self):
-        self.db_path = Path("study_system.db")
+    def __init__(self, db_path="study_system.db", pool_size=8, synchronous="NORMAL",
+                 cache_size=-16000, mmap_size=64 * 1024 * 1024, busy_timeout=5000, trim_every=20,
+                 cache_policies=CACHE_POLICIES, cache_items=1024, cache_check_interval=0.1,
+                 write_mode="immediate", write_window=0.0, write_batch=500):
+        self.db_path = Path(db_path)
+        self.pool_size = pool_size
+        self.pragmas = {"synchronous": synchronous, "cache_size": cache_size,
+                        "mmap_size": mmap_size, "busy_timeout": busy_timeout}
+        # SQLite allows a single writer; in WAL mode readers never wait on it,
+        # so only writes are serialized here.
         self.lock = threading.Lock()
+        self._pool = queue.LifoQueue(maxsize=pool_size)
+        # Lists are capped lazily: once on the first push per process, then every `trim_every` pushes
+        self.trim_every = trim_every
+        self._push_counts = {}
+        # Pass cache_policies={} to always read through to SQLite
+        self.cache = ReadCache(cache_policies, cache_items, cache_check_interval)
         self.init_db()
+        # How set and push commit:
+        #   "immediate"  each in its own transaction before returning
+        #   "group"      queued, and the caller waits for the transaction its window commits in
+        #   "behind"     queued, returning at once; the last window is lost if the process is
+        #                killed, though not on a normal exit. Reads still see the queued values.
+        # Session activities are always written behind. `synchronous` sets what a commit survives.
+        self.write_mode = write_mode
+        self.writes = WriteBatcher(self, write_window, write_batch)
+        self._pending = {}
+        self._pending_lists = {}
+        self._pending_lock = threading.Lock()
         print("SQLite database initialized")
 
     def init_db(self):
-        with sqlite3.connect(self.db_path) as conn:
-            conn.execute('''CREATE TABLE IF NOT EXISTS data (
-                key TEXT PRIMARY KEY, value TEXT)''')
-            conn.execute('''CREATE TABLE IF NOT EXISTS lists (
-                key TEXT, value TEXT, pos INTEGER, 
-                PRIMARY KEY (key, pos))''')
-            conn.execute('''CREATE TABLE IF NOT EXISTS users (
-                user_id TEXT PRIMARY KEY,
-                username TEXT,
-                learning_style TEXT DEFAULT 'visual',
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )''')
+        with self.connection() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            with conn:
+                conn.execute('''CREATE TABLE IF NOT EXISTS data (
+                    key TEXT PRIMARY KEY, value TEXT)''')
+                # Append-only list store: newest item has the highest seq
+                conn.execute('''CREATE TABLE IF NOT EXISTS list_items (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    key TEXT NOT NULL,
+                    value TEXT)''')
+                conn.execute('''CREATE INDEX IF NOT EXISTS idx_list_items_key_seq
+                                ON list_items (key, seq DESC)''')
+                self._migrate_lists(conn)
+                conn.execute('''CREATE TABLE IF NOT EXISTS users (
+                    user_id TEXT PRIMARY KEY,
+                    username TEXT,
+                    learning_style TEXT DEFAULT 'visual',
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )''')
+                conn.execute('''CREATE TABLE IF NOT EXISTS session_activities (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    session_id TEXT NOT NULL,
+                    time TEXT,
+                    activity TEXT,
+                    tokens INTEGER
+                )''')
+                conn.execute('''CREATE INDEX IF NOT EXISTS idx_session_activities_session
+                                ON session_activities (session_id)''')
+                migrate = not conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'content'").fetchone()
+                # Lightweight rows for listing; the zlib-compressed text lives in content_bodies
+                conn.execute('''CREATE TABLE IF NOT EXISTS content (
+                    id TEXT PRIMARY KEY,
+                    user_id TEXT NOT NULL,
+                    filename TEXT,
+                    type TEXT,
+                    preview TEXT,
+                    length INTEGER,
+                    created_at TEXT
+                )''')
+                conn.execute('''CREATE TABLE IF NOT EXISTS content_bodies (
+                    id TEXT PRIMARY KEY,
+                    body BLOB
+                )''')
+                self._split_content_bodies(conn)
+                conn.execute('CREATE INDEX IF NOT EXISTS idx_content_user_created ON content (user_id, created_at)')
+                conn.execute('CREATE INDEX IF NOT EXISTS idx_content_user_filename ON content (user_id, filename)')
+                conn.execute('CREATE INDEX IF NOT EXISTS idx_content_user_type ON content (user_id, type)')
+                conn.execute('''CREATE TABLE IF NOT EXISTS sessions (
+                    id TEXT PRIMARY KEY,
+                    user_id TEXT NOT NULL,
+                    subject TEXT,
+                    started_at TEXT,
+                    ended_at TEXT,
+                    activity_count INTEGER DEFAULT 0,
+                    ai_calls INTEGER DEFAULT 0,
+                    tokens INTEGER DEFAULT 0
+                )''')
+                conn.execute('CREATE INDEX IF NOT EXISTS idx_sessions_user_started ON sessions (user_id, started_at)')
+                self._add_columns(conn, 'session_activities', {'tokens': 'INTEGER'})
+                self._add_columns(conn, 'sessions', {'ai_calls': 'INTEGER DEFAULT 0', 'tokens': 'INTEGER DEFAULT 0'})
+                self._create_search_index(conn)
+                if migrate:
+                    self._migrate_records(conn)
+                self._create_rollups(conn)
+                self._create_cache_version(conn)
+
+    def _create_cache_version(self, conn):
+        """Counter bumped by every write to data and users, from any process.
+
+        Caches compare it with the version they last saw to notice writes
+        they didn't make themselves.
+        """
+        conn.execute('CREATE TABLE IF NOT EXISTS cache_version (version INTEGER NOT NULL)')
+        conn.execute('INSERT INTO cache_version SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM cache_version)')
+        for table in ('data', 'users'):
+            for event in ('INSERT', 'UPDATE', 'DELETE'):
+                conn.execute(f'''CREATE TRIGGER IF NOT EXISTS {table}_{event.lower()}_version
+                                 AFTER {event} ON {table}
+                                 BEGIN UPDATE cache_version SET version = version + 1; END''')
+
+    def _create_search_index(self, conn):
+        """Full-text index over saved content, backfilled from existing items on creation.
+
+        The index is contentless: its rowids are those of `content`, and the
+        text itself is only kept, compressed, in content_bodies.
+        """
+        existing = conn.execute("SELECT sql FROM sqlite_master WHERE name = 'content_fts'").fetchone()
+        if existing and "content=''" in existing['sql']:
+            return
+        if existing:
+            conn.execute('DROP TABLE content_fts')
+        # user_id is indexed so a search only walks that user's postings
+        conn.execute('''CREATE VIRTUAL TABLE content_fts USING fts5(
+            user_id, filename, type, content, content='')''')
+        rows = conn.execute('''SELECT c.rowid, c.user_id, c.filename, c.type, b.body
+                               FROM content c JOIN content_bodies b ON b.id = c.id''')
+        conn.executemany('INSERT INTO content_fts (rowid, user_id, filename, type, content) VALUES (?, ?, ?, ?, ?)',
+                         ((row[0], row[1], row[2], row[3], _decompress(row[4])) for row in rows))
+
+    def _split_content_bodies(self, conn):
+        """Rebuild a content table that still holds full text into metadata rows plus compressed bodies"""
+        columns = {row['name'] for row in conn.execute('PRAGMA table_info(content)')}
+        if 'content' not in columns:
+            return
+        conn.execute('ALTER TABLE content RENAME TO content_inline')
+        conn.execute('''CREATE TABLE content (
+            id TEXT PRIMARY KEY,
+            user_id TEXT NOT NULL,
+            filename TEXT,
+            type TEXT,
+            preview TEXT,
+            length INTEGER,
+            created_at TEXT
+        )''')
+        for row in conn.execute('SELECT rowid, * FROM content_inline ORDER BY rowid').fetchall():
+            self._insert_content(conn, {"id": row['id'], "user": row['user_id'], "filename": row['filename'],
+                                        "type": row['type'], "content": row['content'] or "",
+                                        "created": row['created_at']}, rowid=row['rowid'], index=False)
+        conn.execute('DROP TABLE content_inline')
+        print("Moved content bodies to compressed storage")
+
+    def _add_columns(self, conn, table, columns):
+        """Add columns introduced after `table` was first created"""
+        existing = {row['name'] for row in conn.execute(f'PRAGMA table_info({table})')}
+        for name, definition in columns.items():
+            if name not in existing:
+                conn.execute(f'ALTER TABLE {table} ADD COLUMN {name} {definition}')
+
+    def _create_rollups(self, conn):
+        """Per-user analytics counters, kept current by finish_session and rebuilt from history on creation"""
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'user_stats'").fetchone():
+            return
+        conn.execute('''CREATE TABLE user_stats (
+            user_id TEXT PRIMARY KEY,
+            sessions INTEGER DEFAULT 0,
+            activities INTEGER DEFAULT 0,
+            ai_calls INTEGER DEFAULT 0,
+            tokens INTEGER DEFAULT 0,
+            seconds REAL DEFAULT 0
+        )''')
+        conn.execute('''CREATE TABLE user_subjects (
+            user_id TEXT,
+            subject TEXT,
+            sessions INTEGER DEFAULT 0,
+            last_seen TEXT,
+            PRIMARY KEY (user_id, subject)
+        )''')
+        conn.execute('CREATE INDEX idx_user_subjects_last_seen ON user_subjects (user_id, last_seen)')
+        self._rebuild_rollups(conn)
+
+    def _migrate_records(self, conn):
+        """One-shot move of users, content and sessions out of the key/value store.
+
+        The JSON copies in `data` and the `user_content`/`sessions` lists are
+        dropped afterwards; they only duplicated these rows.
+        """
+        conn.execute('''INSERT INTO users (user_id, learning_style)
+                        SELECT substr(key, 12), COALESCE(json_extract(value, '$.style'), 'visual')
+                        FROM data WHERE key GLOB ? AND true
+                        ON CONFLICT (user_id) DO UPDATE SET learning_style = excluded.learning_style''',
+                     ("study:user:*",))
+        for row in conn.execute('SELECT value FROM data WHERE key GLOB ?', ("study:content:*",)).fetchall():
+            item = json.loads(row['value'])
+            item.setdefault("content", "")
+            self._insert_content(conn, item)
+        # Sessions ended before the activity log existed carry their activities inline; their
+        # AI calls are counted here, since the rollups can't find them in session_activities
+        conn.execute('''INSERT OR IGNORE INTO sessions (id, user_id, subject, started_at, ended_at, activity_count,
+                                                   ai_calls)
+                        SELECT json_extract(value, '$.id'), json_extract(value, '$.user'),
+                               json_extract(value, '$.subject'), json_extract(value, '$.start'),
+                               json_extract(value, '$.end'),
+                               COALESCE(json_extract(value, '$.activity_count'),
+                                        json_array_length(value, '$.activities'), 0),
+                               (SELECT COUNT(*) FROM json_each(data.value, '$.activities') AS a
+                                WHERE json_extract(a.value, '$.activity') LIKE ?)
+                        FROM data WHERE key GLOB ?''', ("%: AI call%", "study:session:*"))
+        moved = conn.execute('DELETE FROM data WHERE key GLOB ? OR key GLOB ? OR key GLOB ?',
+                             ("study:user:*", "study:content:*", "study:session:*")).rowcount
+        conn.execute('DELETE FROM list_items WHERE key GLOB ? OR key GLOB ?',
+                     ("study:user_content:*", "study:sessions:*"))
+        if moved:
+            print(f"Migrated {moved} users, content items and sessions to their own tables")
+
+    def _migrate_lists(self, conn):
+        """Move rows from the old pos-numbered `lists` table into list_items"""
+        if not conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'lists'").fetchone():
+            return
+        # pos 0 was the newest item, so insert highest pos first to keep the order
+        conn.execute('''INSERT INTO list_items (key, value)
+                        SELECT key, value FROM lists ORDER BY key, pos DESC''')
+        conn.execute('DROP TABLE lists')
+        print("Migrated lists table to list_items")
 
     def get_connection(self):
+        """Open a new connection configured with the state's pragmas"""
         conn = sqlite3.connect(self.db_path, check_same_thread=False)
         conn.row_factory = sqlite3.Row
+        for name, value in self.pragmas.items():
+            conn.execute(f'PRAGMA {name}={value}')
         return conn
 
-    def set(self, key, value, expire=None):
-        with self.lock:
+    @contextmanager
+    def connection(self):
+        """Borrow a pooled connection, opening one if the pool is empty"""
+        try:
+            conn = self._pool.get_nowait()
+        except queue.Empty:
+            conn = self.get_connection()
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
             try:
-                with self.get_connection() as conn:
-                    conn.execute('INSERT OR REPLACE INTO data VALUES (?, ?)',
-                                 (f"study:{key}", json.dumps(value)))
-            except Exception as e:
-                print(f"Error setting {key}: {e}")
+                self._pool.put_nowait(conn)
+            except queue.Full:
+                conn.close()
 
-    def get(self, key, default=None):
-        with self.lock:
+    @contextmanager
+    def transaction(self):
+        """Serialized write transaction on a pooled connection"""
+        with self.lock, self.connection() as conn, conn:
+            yield conn
+
+    def flush(self):
+        """Block until every queued write is committed"""
+        self.writes.flush()
+
+    def on_ready(self, setup):
+        """Run setup() now; the database is already open (see LazyState)"""
+        setup()
+
+    def close(self):
+        """Commit queued writes, then close every idle pooled connection"""
+        self.flush()
+        while True:
             try:
-                with self.get_connection() as conn:
-                    row = conn.execute('SELECT value FROM data WHERE key = ?',
-                                       (f"study:{key}",)).fetchone()
-                    return json.loads(row['value']) if row else default
-            except Exception as e:
-                print(f"Error getting {key}: {e}")
-                return default
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                return
+
+    @metrics.timed("sqlite.set")
+    def set(self, key, value, expire=None):
+        text = json.dumps(value)
+        written = {}
+
+        def write(conn):
+            conn.execute('INSERT OR REPLACE INTO data VALUES (?, ?)', (f"study:{key}", text))
+            written["version"] = self._cache_version(conn)
+
+        if self.write_mode != "behind":
+            if self._write(write, f"setting {key}"):
+                self.cache.invalidate(key, written["version"])
+            return
+        # Until the write commits, get(key) answers from here
+        marker = object()
+        with self._pending_lock:
+            self._pending[key] = (marker, text)
+
+        def committed(error):
+            # Invalidate before dropping the pending value, so reads never fall back to a stale entry
+            if not error:
+                self.cache.invalidate(key, written["version"])
+            with self._pending_lock:
+                if self._pending.get(key, (None,))[0] is marker:
+                    del self._pending[key]
+            if error:
+                print(f"Error setting {key}: {error}")
+
+        self.writes.submit(write, done=committed)
+
+    def _write(self, write, action):
+        """Run write(conn) now ("immediate") or in the next group commit, waiting for it ("group");
+        True once it has committed"""
+        try:
+            if self.write_mode == "immediate":
+                with self.transaction() as conn:
+                    write(conn)
+            else:
+                self.writes.submit(write, wait=True)
+            return True
+        except Exception as e:
+            print(f"Error {action}: {e}")
+            return False
+
+    @metrics.timed("sqlite.get")
+    def get(self, key, default=None):
+        pending = self._pending.get(key)
+        if pending:
+            return json.loads(pending[1])
+        try:
+            value = self._cached(key, lambda conn: self._load(conn, key))
+            return default if value is None else value
+        except Exception as e:
+            print(f"Error getting {key}: {e}")
+            return default
+
+    def _load(self, conn, key):
+        row = conn.execute('SELECT value FROM data WHERE key = ?', (f"study:{key}",)).fetchone()
+        return json.loads(row['value']) if row else None
+
+    def _cached(self, key, load):
+        """load(conn) for `key`, served from the read cache when its prefix has a policy"""
+        ttl = self.cache.ttl(key)
+        if ttl is None:
+            with self.connection() as conn:
+                return load(conn)
+        with self.connection() as conn:
+            if self.cache.due():
+                self.cache.sync(conn.execute('SELECT version FROM cache_version').fetchone()[0])
+            hit, value = self.cache.get(key)
+            if hit:
+                return value
+            generation = self.cache.generation
+            value = load(conn)
+        self.cache.put(key, value, ttl, generation)
+        return copy.copy(value)
 
+    @staticmethod
+    def _cache_version(conn):
+        """The cache_version a write in conn's transaction leaves behind. The cache is only
+        invalidated with it after the commit: a reader that missed in between would otherwise
+        cache the old row as current."""
+        return conn.execute('SELECT version FROM cache_version').fetchone()[0]
+
+    def cache_stats(self):
+        return self.cache.stats()
+
+    @metrics.timed("sqlite.push")
     def push(self, key, value, max_items=100):
-        with self.lock:
-            try:
-                with self.get_connection() as conn:
-                    conn.execute('UPDATE lists SET pos = pos + 1 WHERE key = ?',
-                                 (f"study:{key}",))
-                    conn.execute('INSERT INTO lists VALUES (?, ?, 0)',
-                                 (f"study:{key}", json.dumps(value)))
-                    conn.execute('DELETE FROM lists WHERE key = ? AND pos >= ?',
-                                 (f"study:{key}", max_items))
-            except Exception as e:
-                print(f"Error pushing to {key}: {e}")
+        text = json.dumps(value)
+
+        def write(conn):
+            conn.execute('INSERT INTO list_items (key, value) VALUES (?, ?)', (f"study:{key}", text))
+            count = self._push_counts.get(key, 0)
+            self._push_counts[key] = count + 1
+            if count % self.trim_every == 0:
+                self._trim(conn, key, max_items)
+
+        if self.write_mode != "behind":
+            return self._write(write, f"pushing to {key}")
+        # Reads of the list flush first while any of these are queued
+        with self._pending_lock:
+            self._pending_lists[key] = self._pending_lists.get(key, 0) + 1
+
+        def committed(error):
+            with self._pending_lock:
+                self._pending_lists[key] -= 1
+                if not self._pending_lists[key]:
+                    del self._pending_lists[key]
+            if error:
+                print(f"Error pushing to {key}: {error}")
+
+        self.writes.submit(write, done=committed)
+
+    def add_activity(self, session_id, activity, tokens=None):
+        """Queue an activity for the next group commit"""
+        row = (session_id, datetime.now().strftime("%H:%M"), activity, tokens)
+        self.writes.submit(lambda conn: conn.execute(
+            'INSERT INTO session_activities (session_id, time, activity, tokens) VALUES (?, ?, ?, ?)', row),
+            done=lambda error: error and print(f"Error logging activity for {session_id}: {error}"))
+
+    def _trim(self, conn, key, max_items):
+        """Drop everything older than the newest `max_items` entries of a list"""
+        conn.execute('''DELETE FROM list_items WHERE key = ? AND seq <= (
+                            SELECT seq FROM list_items WHERE key = ?
+                            ORDER BY seq DESC LIMIT 1 OFFSET ?)''',
+                     (f"study:{key}", f"study:{key}", max_items))
 
     def get_list(self, key, limit=20):
-        with self.lock:
-            try:
-                with self.get_connection() as conn:
-                    rows = conn.execute('''SELECT value FROM lists 
-                                        WHERE key = ? ORDER BY pos LIMIT ?''',
+        items, _ = self.get_list_page(key, limit)
+        return items
+
+    @metrics.timed("sqlite.get_list_page")
+    def get_list_page(self, key, limit=20, before=None):
+        """Newest-first page of a list; pass the returned cursor as `before` for the next page"""
+        if key in self._pending_lists:
+            self.flush()
+        try:
+            with self.connection() as conn:
+                if before is None:
+                    rows = conn.execute('''SELECT seq, value FROM list_items
+                                        WHERE key = ? ORDER BY seq DESC LIMIT ?''',
                                         (f"study:{key}", limit)).fetchall()
-                    return [json.loads(row['value']) for row in rows]
-            except Exception as e:
-                print(f"Error getting list {key}: {e}")
-                return []
+                else:
+                    rows = conn.execute('''SELECT seq, value FROM list_items
+                                        WHERE key = ? AND seq < ? ORDER BY seq DESC LIMIT ?''',
+                                        (f"study:{key}", before, limit)).fetchall()
+                cursor = rows[-1]['seq'] if len(rows) == limit else None
+                return [json.loads(row['value']) for row in rows], cursor
+        except Exception as e:
+            print(f"Error getting list {key}: {e}")
+            return [], None
 
-    def store_user(self, user_id, username, learning_style='visual'):
-        with self.lock:
-            try:
-                with self.get_connection() as conn:
-                    conn.execute('''INSERT OR REPLACE INTO users 
-                                    (user_id, username, learning_style)
-                                    VALUES (?, ?, ?)''',
-                                 (user_id, username, learning_style))
+    def get_activities(self, session_id):
+        try:
+            with self.connection() as conn:
+                rows = conn.execute('''SELECT time, activity FROM session_activities
+                                    WHERE session_id = ? ORDER BY id''', (session_id,)).fetchall()
+                return [dict(row) for row in rows]
+        except Exception as e:
+            print(f"Error getting activities for {session_id}: {e}")
+            return []
+
+    def count_activities(self, session_id):
+        try:
+            with self.connection() as conn:
+                return conn.execute('SELECT COUNT(*) FROM session_activities WHERE session_id = ?',
+                                    (session_id,)).fetchone()[0]
+        except Exception as e:
+            print(f"Error counting activities for {session_id}: {e}")
+            return 0
+
+    @metrics.timed("sqlite.add_content")
+    def add_content(self, item):
+        """Insert a content item and add it to the full-text index"""
+        try:
+            with self.transaction() as conn:
+                self._insert_content(conn, item)
+        except Exception as e:
+            print(f"Error saving content {item.get('id')}: {e}")
+
+    def _insert_content(self, conn, item, rowid=None, index=True):
+        text = item["content"]
+        cursor = conn.execute('''INSERT OR IGNORE INTO content
+                                  (rowid, id, user_id, filename, type, preview, length, created_at)
+                                  VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
+                              (rowid, item["id"], item["user"], item["filename"], item["type"],
+                               text[:PREVIEW_CHARS], len(text), item["created"]))
+        if not cursor.rowcount:
+            return
+        conn.execute('INSERT OR REPLACE INTO content_bodies VALUES (?, ?)',
+                     (item["id"], zlib.compress(text.encode('utf-8'))))
+        if index:
+            conn.execute('''INSERT INTO content_fts (rowid, user_id, filename, type, content)
+                            VALUES (?, ?, ?, ?, ?)''',
+                         (cursor.lastrowid, item["user"], item["filename"], item["type"], text))
+
+    @metrics.timed("sqlite.get_content")
+    def get_content(self, content_id):
+        """A content item including its full text"""
+        try:
+            with self.connection() as conn:
+                row = conn.execute(f'''SELECT {CONTENT_COLUMNS}, body FROM content
+                                     JOIN content_bodies USING (id) WHERE id = ?''', (content_id,)).fetchone()
+            if not row:
+                return None
+            item = dict(row)
+            item["content"] = _decompress(item.pop("body"))
+            return item
+        except Exception as e:
+            print(f"Error getting content {content_id}: {e}")
+            return None
+
+    @metrics.timed("sqlite.list_content")
+    def list_content(self, user_id, limit=20, filename=None, content_type=None, with_content=False):
+        """A user's content newest first, optionally only one file's or one type's.
+
+        Items carry a preview and length; pass with_content=True to load full text too.
+        """
+        items, _ = self.list_content_page(user_id, limit, None, filename, content_type, with_content)
+        return items
+
+    @metrics.timed("sqlite.list_content_page")
+    def list_content_page(self, user_id, limit=20, before=None, filename=None, content_type=None,
+                          with_content=False):
+        """Newest-first page of a user's content; pass the returned cursor as `before` for the next page"""
+        where, params = 'user_id = ?', [user_id]
+        if before is not None:
+            where, params = where + ' AND created_at < ?', params + [before]
+        if filename is not None:
+            where, params = where + ' AND filename = ?', params + [filename]
+        if content_type is not None:
+            where, params = where + ' AND type = ?', params + [content_type]
+        columns, join = CONTENT_COLUMNS, ''
+        if with_content:
+            columns, join = CONTENT_COLUMNS + ', body', 'JOIN content_bodies USING (id)'
+        try:
+            with self.connection() as conn:
+                rows = conn.execute(f'''SELECT {columns} FROM content {join} WHERE {where}
+                                     ORDER BY created_at DESC LIMIT ?''', params + [limit]).fetchall()
+            items = [dict(row) for row in rows]
+            for item in items:
+                if with_content:
+                    item["content"] = _decompress(item.pop("body"))
+            cursor = items[-1]["created"] if len(items) == limit else None
+            return items, cursor
+        except Exception as e:
+            print(f"Error listing content for {user_id}: {e}")
+            return [], None
+
+    @metrics.timed("sqlite.save_session")
+    def save_session(self, session):
+        try:
+            with self.transaction() as conn:
+                conn.execute('''INSERT OR REPLACE INTO sessions
+                                (id, user_id, subject, started_at, ended_at, activity_count)
+                                VALUES (?, ?, ?, ?, ?, ?)''',
+                             (session["id"], session["user"], session.get("subject"), session.get("start"),
+                              session.get("end"), session.get("activity_count", 0)))
+        except Exception as e:
+            print(f"Error saving session {session.get('id')}: {e}")
+
+    def get_session(self, session_id):
+        try:
+            with self.connection() as conn:
+                row = conn.execute(f'SELECT {SESSION_COLUMNS} FROM sessions WHERE id = ?', (session_id,)).fetchone()
+                return dict(row) if row else None
+        except Exception as e:
+            print(f"Error getting session {session_id}: {e}")
+            return None
+
+    def list_sessions(self, user_id, limit=10):
+        """A user's finished sessions, most recent first"""
+        try:
+            with self.connection() as conn:
+                rows = conn.execute(f'''SELECT {SESSION_COLUMNS} FROM sessions
+                                     WHERE user_id = ? AND ended_at IS NOT NULL
+                                     ORDER BY started_at DESC LIMIT ?''', (user_id, limit)).fetchall()
+                return [dict(row) for row in rows]
+        except Exception as e:
+            print(f"Error listing sessions for {user_id}: {e}")
+            return []
+
+    @metrics.timed("sqlite.finish_session")
+    def finish_session(self, session_id, ended_at):
+        """Close a session and add it to its user's rollups; False if it was already closed"""
+        try:
+            with self.transaction() as conn:
+                session = conn.execute('SELECT user_id, subject, ended_at FROM sessions WHERE id = ?',
+                                       (session_id,)).fetchone()
+                if not session or session['ended_at']:
+                    return False
+                # Only AI calls carry a token count (0 when answered from the cache)
+                conn.execute('''UPDATE sessions SET ended_at = ?,
+                                    (activity_count, ai_calls, tokens) = (
+                                        SELECT COUNT(*), COUNT(tokens), COALESCE(SUM(tokens), 0)
+                                        FROM session_activities WHERE session_id = ?)
+                                WHERE id = ?''', (ended_at, session_id, session_id))
+                conn.execute('''INSERT INTO user_stats (user_id, sessions, activities, ai_calls, tokens, seconds)
+                                SELECT user_id, 1, activity_count, ai_calls, tokens,
+                                       (julianday(ended_at) - julianday(started_at)) * 86400
+                                FROM sessions WHERE id = ? AND true
+                                ON CONFLICT (user_id) DO UPDATE SET
+                                    sessions = sessions + 1,
+                                    activities = activities + excluded.activities,
+                                    ai_calls = ai_calls + excluded.ai_calls,
+                                    tokens = tokens + excluded.tokens,
+                                    seconds = seconds + excluded.seconds''', (session_id,))
+                if session['subject']:
+                    conn.execute('''INSERT INTO user_subjects (user_id, subject, sessions, last_seen)
+                                    VALUES (?, ?, 1, ?)
+                                    ON CONFLICT (user_id, subject) DO UPDATE SET
+                                        sessions = sessions + 1,
+                                        last_seen = MAX(last_seen, excluded.last_seen)''',
+                                 (session['user_id'], session['subject'], ended_at))
                 return True
-            except Exception as e:
-                print(f"Error storing user: {e}")
-                return False
+        except Exception as e:
+            print(f"Error finishing session {session_id}: {e}")
+            return False
+
+    def rebuild_rollups(self, user_id=None):
+        """Recompute analytics counters from session history, for one user or everyone"""
+        try:
+            with self.transaction() as conn:
+                self._rebuild_rollups(conn, user_id)
+        except Exception as e:
+            print(f"Error rebuilding analytics: {e}")
+
+    def _rebuild_rollups(self, conn, user_id=None):
+        where, params = ('AND user_id = ?', (user_id,)) if user_id else ('', ())
+        # Refresh per-session counters from the activity log where it still exists. AI calls
+        # logged before token counts were recorded are recognised by their message.
+        conn.execute(f'''UPDATE sessions SET (ai_calls, tokens) = (
+                             SELECT COUNT(*), COALESCE(SUM(tokens), 0) FROM session_activities
+                             WHERE session_id = sessions.id
+                               AND (tokens IS NOT NULL OR activity LIKE '%: AI call%'))
+                         WHERE ended_at IS NOT NULL {where}
+                           AND EXISTS (SELECT 1 FROM session_activities WHERE session_id = sessions.id)''',
+                     params)
+        conn.execute(f'DELETE FROM user_stats WHERE true {where}', params)
+        conn.execute(f'DELETE FROM user_subjects WHERE true {where}', params)
+        conn.execute(f'''INSERT INTO user_stats (user_id, sessions, activities, ai_calls, tokens, seconds)
+                         SELECT user_id, COUNT(*), SUM(activity_count), SUM(ai_calls), SUM(tokens),
+                                COALESCE(SUM((julianday(ended_at) - julianday(started_at)) * 86400), 0)
+                         FROM sessions WHERE ended_at IS NOT NULL {where} GROUP BY user_id''', params)
+        conn.execute(f'''INSERT INTO user_subjects (user_id, subject, sessions, last_seen)
+                         SELECT user_id, subject, COUNT(*), MAX(ended_at)
+                         FROM sessions WHERE ended_at IS NOT NULL AND subject != '' {where}
+                         GROUP BY user_id, subject''', params)
+
+    @metrics.timed("sqlite.user_analytics")
+    def user_analytics(self, user_id, subjects=10):
+        """A user's rollup counters plus their most recently studied subjects"""
+        try:
+            with self.connection() as conn:
+                row = conn.execute('''SELECT sessions, activities, ai_calls, tokens, seconds
+                                      FROM user_stats WHERE user_id = ?''', (user_id,)).fetchone()
+                stats = dict(row) if row else {"sessions": 0, "activities": 0, "ai_calls": 0,
+                                               "tokens": 0, "seconds": 0.0}
+                stats["subjects"] = [r['subject'] for r in conn.execute(
+                    '''SELECT subject FROM user_subjects WHERE user_id = ?
+                       ORDER BY last_seen DESC LIMIT ?''', (user_id, subjects))]
+                return stats
+        except Exception as e:
+            print(f"Error getting analytics for {user_id}: {e}")
+            return {"sessions": 0, "activities": 0, "ai_calls": 0, "tokens": 0, "seconds": 0.0, "subjects": []}
+
+    @metrics.timed("sqlite.search_content")
+    def search_content(self, user_id, query, limit=20, offset=0):
+        """A user's content matching query, best bm25 match first, with highlighted snippets"""
+        terms = re.findall(r"(\w+)(\*?)", query)
+        if not terms:
+            return []
+        # Quote every term so user input can't break FTS syntax; a trailing * still prefix-matches
+        # The user_id phrase only narrows the FTS scan: it also matches ids that merely contain
+        # the same tokens ("abc" in "abc-def"), so the user is checked exactly in SQL too
+        quoted = str(user_id).replace('"', '""')
+        match = f'user_id:"{quoted}" AND ' + " ".join(f'"{term}"{star}' for term, star in terms)
+        try:
+            with self.connection() as conn:
+                rows = conn.execute('''SELECT c.id, c.filename, c.type, c.created_at AS created, b.body,
+                                           bm25(content_fts, 0.0, 4.0, 2.0, 1.0) AS score
+                                    FROM content_fts
+                                    JOIN content c ON c.rowid = content_fts.rowid
+                                    JOIN content_bodies b ON b.id = c.id
+                                    WHERE content_fts MATCH ? AND c.user_id = ?
+                                    ORDER BY score LIMIT ? OFFSET ?''',
+                                    (match, user_id, limit, offset)).fetchall()
+            hits = []
+            for row in rows:
+                hit = dict(row)
+                # The index is contentless, so snippets are cut from the stored body
+                hit["snippet"] = _snippet(_decompress(hit.pop("body")), terms)
+                hits.append(hit)
+            return hits
+        except Exception as e:
+            print(f"Error searching content: {e}")
+            return []
+
+    @metrics.timed("sqlite.store_user")
+    def store_user(self, user_id, username=None, learning_style=None):
+        """Create or update a user; fields passed as None keep their stored value"""
+        try:
+            with self.transaction() as conn:
+                conn.execute('''INSERT INTO users (user_id, username, learning_style)
+                                VALUES (?, ?, COALESCE(?, 'visual'))
+                                ON CONFLICT (user_id) DO UPDATE SET
+                                    username = COALESCE(?, username),
+                                    learning_style = COALESCE(?, learning_style)''',
+                             (user_id, username, learning_style, username, learning_style))
+                version = self._cache_version(conn)
+            self.cache.invalidate(f"users:{user_id}", version)
+            return True
+        except Exception as e:
+            print(f"Error storing user: {e}")
+            return False
+
+    @metrics.timed("sqlite.get_user")
+    def get_user(self, user_id):
+        def load(conn):
+            row = conn.execute('''SELECT user_id AS id, username, learning_style AS style,
+                                      created_at AS created
+                               FROM users WHERE user_id = ?''', (user_id,)).fetchone()
+            return dict(row) if row else None
+
+        try:
+            return self._cached(f"users:{user_id}", load)
+        except Exception as e:
+            print(f"Error getting user {user_id}: {e}")
+            return None
 
     def find_by_username(self, username):
-        with self.lock:
-            try:
-                with self.get_connection() as conn:
-                    row = conn.execute('SELECT * FROM users WHERE username = ?',
-                                       (username,)).fetchone()
-                    return dict(row) if row else None
-            except Exception as e:
-                return None
+        try:
+            with self.connection() as conn:
+                row = conn.execute('SELECT * FROM users WHERE username = ?',
+                                   (username,)).fetchone()
+                return dict(row) if row else None
+        except Exception as e:
+            return None
 
     def get_stats(self):
         try:
-            with self.get_connection() as conn:
+            with self.connection() as conn:
                 key_count = conn.execute('SELECT COUNT(*) FROM data').fetchone()[0]
-                list_count = conn.execute('SELECT COUNT(DISTINCT key) FROM lists').fetchone()[0]
+                list_count = conn.execute('SELECT COUNT(DISTINCT key) FROM list_items').fetchone()[0]
                 user_count = conn.execute('SELECT COUNT(*) FROM users').fetchone()[0]
+                content_count = conn.execute('SELECT COUNT(*) FROM content').fetchone()[0]
+                session_count = conn.execute('SELECT COUNT(*) FROM sessions').fetchone()[0]
                 return {
                     'total_keys': key_count,
                     'total_lists': list_count,
                     'total_users': user_count,
+                    'total_content': content_count,
+                    'total_sessions': session_count,
                     'database_path': str(self.db_path.absolute())
                 }
         except:
             return {}
 
 
-# Global state
-state = SQLiteState()
+PREVIEW_CHARS = 150
+
+
+def _decompress(body):
+    return zlib.decompress(body).decode('utf-8')
+
+
+def _snippet(text, terms, words=24):
+    """About `words` words of text around the first query match, matches in bold"""
+    pattern = re.compile(r"\b(?:" + "|".join(re.escape(term) + (r"\w*" if star else r"\b")
+                                             for term, star in terms) + ")", re.IGNORECASE)
+    tokens = text.split()
+    first = next((i for i, token in enumerate(tokens) if pattern.search(token)), 0)
+    start = max(0, first - words // 4)
+    window = [pattern.sub(lambda m: f"**{m.group(0)}**", token) for token in tokens[start:start + words]]
+    return ("…" if start else "") + " ".join(window) + ("…" if start + words < len(tokens) else "")
+
+
+class ReadCache:
+    """Bounded LRU of small, hot reads, each kept for its key prefix's TTL.
+
+    Misses are cached too, as None. A local write drops its key. Writes
+    from other processes show up as the cache_version counter moving by
+    more than this process's own writes, which drops everything; that is
+    checked at most every `check_interval` seconds, so other processes'
+    writes are seen that late at worst.
+    """
+
+    def __init__(self, policies, max_items=1024, check_interval=0.1):
+        # Longest prefix first, so the most specific policy wins
+        self.policies = sorted(policies.items(), key=lambda item: -len(item[0]))
+        self.max_items = max_items
+        self.check_interval = check_interval
+        # Bumped on every invalidation; a load that started before one isn't cached
+        self.generation = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self._version = None
+        self._checked = 0.0
+        self._counts = {prefix: {"hits": 0, "misses": 0} for prefix, _ in self.policies}
+        self._evictions = self._invalidations = self._resets = 0
+
+    def _prefix(self, key):
+        for prefix, ttl in self.policies:
+            if key.startswith(prefix):
+                return prefix, ttl
+        return None, None
+
+    def ttl(self, key):
+        return self._prefix(key)[1]
+
+    def due(self):
+        return time.monotonic() - self._checked >= self.check_interval
+
+    def sync(self, version):
+        """Note the current cache_version, dropping everything if someone else has written"""
+        with self._lock:
+            self._checked = time.monotonic()
+            if version != self._version:
+                if self._version is not None:
+                    self._clear()
+                self._version = version
+
+    def get(self, key):
+        prefix, _ = self._prefix(key)
+        with self._lock:
+            entry = self._items.get(key)
+            if entry is None or entry[1] < time.monotonic():
+                self._counts[prefix]["misses"] += 1
+                return False, None
+            self._items.move_to_end(key)
+            self._counts[prefix]["hits"] += 1
+        # Callers may modify what they get back; a shallow copy covers profile rows
+        return True, copy.copy(entry[0])
+
+    def put(self, key, value, ttl, generation):
+        with self._lock:
+            if generation != self.generation:
+                return
+            self._items[key] = (value, time.monotonic() + ttl)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+                self._evictions += 1
+
+    def invalidate(self, key, version):
+        """Drop `key` after a local write that left the counter at `version`"""
+        with self._lock:
+            self.generation += 1
+            self._invalidations += 1
+            self._items.pop(key, None)
+            # Only our own write since the last sync: nothing else can be stale
+            if self._version is not None and version == self._version + 1:
+                self._version = version
+            else:
+                self._clear()
+                self._version = version
+
+    def _clear(self):
+        self.generation += 1
+        self._resets += 1
+        self._items.clear()
+
+    def stats(self):
+        """Hits, misses and hit rate per prefix, plus size and invalidation counts"""
+        with self._lock:
+            prefixes = {prefix: {**counts, "hit_rate": counts["hits"] / max(counts["hits"] + counts["misses"], 1)}
+                        for prefix, counts in self._counts.items()}
+            return {"prefixes": prefixes, "size": len(self._items), "evictions": self._evictions,
+                    "invalidations": self._invalidations, "resets": self._resets}
+
+
+class WriteBatcher:
+    """Group commit for small writes.
+
+    Writes are functions of a connection, queued from any thread. A daemon
+    thread takes whatever is queued, waits up to `window` seconds for more
+    (or until `batch_size`), and runs the lot in one transaction, so many
+    writes share one commit. With no window, batches are whatever queued
+    up while the previous commit ran: no added latency when idle. If the transaction fails, each write is
+    retried on its own so one bad write doesn't take the rest with it.
+    """
+
+    def __init__(self, db, window=0.0, batch_size=500):
+        self.db = db
+        self.window = window
+        self.batch_size = batch_size
+        self._queue = queue.Queue()
+        self._thread = None
+        self._start_lock = threading.Lock()
+
+    def submit(self, write, wait=False, done=None):
+        """Queue write(conn); done(error) is called once it has committed or failed.
+        With wait, block until then and raise the error, if any."""
+        committed = threading.Event() if wait else None
+        outcome = {}
+
+        def finish(error):
+            outcome["error"] = error
+            if done:
+                done(error)
+            if committed:
+                committed.set()
+
+        self._queue.put((write, finish))
+        if self._thread is None:
+            self._start()
+        if wait:
+            committed.wait()
+            if outcome["error"]:
+                raise outcome["error"]
+
+    def flush(self):
+        """Block until every queued write is committed"""
+        self._queue.join()
+
+    def _start(self):
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="write-batcher", daemon=True)
+                self._thread.start()
+                # Nothing queued is lost on a normal exit
+                atexit.register(self.flush)
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.batch_size:
+                try:
+                    remaining = deadline - time.monotonic()
+                    batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                errors = self._commit(batch)
+            except Exception:
+                errors = [self._commit([entry])[0] for entry in batch]
+            for (_, finish), error in zip(batch, errors):
+                try:
+                    finish(error)
+                except Exception as e:
+                    print(f"Error after write: {e}")
+                finally:
+                    self._queue.task_done()
+
+    def _commit(self, batch):
+        """Run every write in one transaction; returns a per-write error list (all None),
+        or for a single write, its error instead of raising"""
+        try:
+            with metrics.span("sqlite.commit", writes=len(batch)), self.db.transaction() as conn:
+                for write, _ in batch:
+                    write(conn)
+            return [None] * len(batch)
+        except Exception as e:
+            if len(batch) > 1:
+                raise
+            return [e]
+
+
+class LazyState:
+    """Stands in for a SQLiteState that is only opened on first use.
+
+    Importing a module that holds one touches no files, which keeps app
+    start-up and process-pool workers (which import the agents but never
+    use the database) fast. Attribute access is passed through.
+    """
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._instance = None
+        self._ready = False
+        self._setups = []
+        # Reentrant: on_ready callbacks use the state while it is being opened
+        self._lock = threading.RLock()
+
+    def _resolve(self):
+        if self._ready:
+            return self._instance
+        with self._lock:
+            if self._instance is None:
+                self._instance = self._factory()
+                for setup in list(self._setups):
+                    setup()
+                self._ready = True
+            return self._instance
+
+    def on_ready(self, setup):
+        """Run setup() once the database is open, e.g. to create a module's tables,
+        and again whenever use() switches to another database"""
+        with self._lock:
+            self._setups.append(setup)
+            if self._instance is None:
+                return
+        setup()
+
+    def use(self, factory):
+        """Open the database from factory() on next use instead, closing the current
+        one; returns the previous factory. For benchmarks and tests."""
+        with self._lock:
+            previous, instance = self._factory, self._instance
+            self._ready = False
+            self._instance = None
+            self._factory = factory
+        if instance is not None:
+            instance.close()
+        return previous
+
+    def __getattr__(self, name):
+        return getattr(self._resolve(), name)
+
+
+# Global state, opened on first use. Session pointers and lists are written behind;
+# everything else commits immediately.
+state = LazyState(lambda: SQLiteState(write_mode="behind"))
 
 
 def get_user(user_id):
-    return state.get(f"user:{user_id}", {})
+    return state.get_user(user_id) or {}
+
+
+def update_user(user_id, username=None, style=None):
+    return state.store_user(user_id, username, style)
 
 
 def start_session(user_id, subject):
     session_id = str(uuid.uuid4())
     session = {"id": session_id, "user": user_id, "subject": subject,
-               "start": datetime.now().isoformat(), "activities": []}
-    state.set(f"session:{session_id}", session)
+               "start": datetime.now().isoformat()}
+    state.save_session(session)
     state.set(f"current_session:{user_id}", session_id)
     return session_id
 
 
-def log_activity(session_id, activity):
-    session = state.get(f"session:{session_id}", {})
-    if session:
-        session["activities"] = session.get("activities", []) + [
-            {"time": datetime.now().strftime("%H:%M"), "activity": activity}]
-        state.set(f"session:{session_id}", session)
+def log_activity(session_id, activity, tokens=None):
+    """Queue an activity; AI calls pass the tokens they used"""
+    state.add_activity(session_id, activity, tokens)
+
+
+def get_session_activities(session_id):
+    state.flush()
+    return state.get_activities(session_id)
 
 
 def end_session(session_id):
-    session = state.get(f"session:{session_id}", {})
-    if session:
-        session["end"] = datetime.now().isoformat()
-        state.set(f"session:{session_id}", session)
-        if "user" in session:
-            state.push(f"sessions:{session['user']}", session)
+    state.flush()
+    state.finish_session(session_id, datetime.now().isoformat())
 
 
 def save_content(user_id, filename, content_type, content):
     content_id = str(uuid.uuid4())
     data = {"id": content_id, "user": user_id, "filename": filename,
             "type": content_type, "content": content, "created": datetime.now().isoformat()}
-    state.set(f"content:{content_id}", data)
-    state.push(f"user_content:{user_id}", data)
+    state.add_content(data)
     return content_id
 
 
+def get_content(content_id):
+    return state.get_content(content_id)
+
+
+def search_content(user_id, query, limit=20, offset=0):
+    return state.search_content(user_id, query, limit, offset)
+
+
 def get_user_sessions(user_id, limit=10):
-    return state.get_list(f"sessions:{user_id}", limit)
+    return state.list_sessions(user_id, limit)
 
 
-def get_user_content(user_id, limit=10):
-    return state.get_list(f"user_content:{user_id}", limit)
+def get_user_content(user_id, limit=10, filename=None, content_type=None, with_content=False):
+    return state.list_content(user_id, limit, filename, content_type, with_content)
+
+
+def get_user_content_page(user_id, limit=20, before=None):
+    return state.list_content_page(user_id, limit, before)
 
 
 def get_analytics(user_id):
-    sessions = get_user_sessions(user_id, 50)
-    subjects = list(set(s.get("subject", "Unknown") for s in sessions if s.get("subject")))
-    return {"sessions": len(sessions), "subjects": subjects}
+    return state.user_analytics(user_id)
+
+
+def rebuild_analytics(user_id=None):
+    state.rebuild_rollups(user_id)
@@ -1,26 +1,127 @@
 import streamlit as st
-import tempfile
-import os
 import hashlib
+import os
+import time
 
 from SQLiteState import *
 from study_planner_agent import StudyPlannerAgent
 from content_processor_agent import ContentProcessorAgent
+from llm_backends import load_env
+from llm_cache import single_flight
+from llm_scheduler import LLMError, scheduler
+from job_queue import jobs, store_upload
+from metrics import metrics
 from datetime import datetime
 
 st.set_page_config(page_title="Study System", layout="wide")
 
+load_env()
+
+# Usernames (comma-separated) that see the Performance tab
+ADMIN_USERS = {name.strip().lower() for name in os.getenv("ADMIN_USERS", "").split(",") if name.strip()}
+METRICS_FILE = os.getenv("METRICS_FILE", "metrics.prom")
+
 
 @st.cache_resource
 def get_agents():
     planner = StudyPlannerAgent()
     processor = ContentProcessorAgent()
     planner.register_content_processor(processor)
+    # Pick up jobs a previous run of the app left queued or unfinished
+    jobs.start()
     return planner, processor
 
 
 planner, processor = get_agents()
 
+
+def token_stream(placeholder):
+    """on_token callback that renders a response into placeholder as it streams in"""
+    parts = []
+
+    def on_token(delta):
+        parts.append(delta)
+        placeholder.markdown("".join(parts) + "▌")
+
+    return on_token
+
+
+def open_item(content_id, key):
+    """Toggle that loads and shows an item's full text and download button only when switched on"""
+    if not st.toggle("Open", key=f"open_{key}"):
+        return
+    item = get_content(content_id)
+    if item:
+        st.markdown(item['content'])
+        st.download_button(f"Download {item['type']}", item['content'],
+                           f"{item['type']}_{item['filename']}_{item['created'][:10]}.txt",
+                           key=f"download_{key}")
+
+
+def performance_panel():
+    """Latency percentiles, tokens and cost per operation, from the in-memory spans"""
+    windows = {"Last 5 minutes": 300, "Last hour": 3600, "Since start": None}
+    window = st.radio("Window", list(windows), horizontal=True)
+    since = time.time() - windows[window] if windows[window] else None
+    summary = metrics.summary(since)
+    if not summary:
+        st.info("Nothing recorded yet.")
+        return
+
+    rows = [{"Operation": name, "Count": row["count"], "Errors": row["errors"],
+             "p50 (ms)": round(row["p50"] * 1000, 1), "p95 (ms)": round(row["p95"] * 1000, 1),
+             "p99 (ms)": round(row["p99"] * 1000, 1),
+             "Tokens": row.get("prompt_tokens", 0) + row.get("completion_tokens", 0),
+             "Cost ($)": round(row.get("cost_usd", 0.0), 4)}
+            for name, row in summary.items()]
+    st.dataframe(rows, use_container_width=True, hide_index=True)
+
+    cache = state.cache_stats()["prefixes"]
+    flights = single_flight.stats()
+    col1, col2, col3, col4 = st.columns(4)
+    col1.metric("LLM calls / retries", f"{scheduler.stats['calls']} / {scheduler.stats['retries']}")
+    col2.metric("LLM failures", scheduler.stats["failures"])
+    col3.metric("Duplicate LLM calls merged", flights["merged"])
+    col4.metric("State cache hit rate",
+                " · ".join(f"{prefix} {counts['hit_rate']:.0%}" for prefix, counts in cache.items()) or "off")
+
+    if st.button("Export Prometheus metrics"):
+        path = metrics.write_prometheus(METRICS_FILE)
+        st.success(f"Wrote {path}")
+    st.download_button("Download metrics.prom", metrics.prometheus(), "metrics.prom")
+
+
+JOB_LABELS = {"summary": "Summary", "notes": "Notes", "questions": "Questions", "file_plan": "File-Based Plan",
+              "ingest": "Library import"}
+
+
+@st.fragment(run_every=2)
+def job_panel(user_id):
+    """The user's recent jobs; re-polled every 2 seconds without rerunning the page"""
+    recent = jobs.list(user_id, 5)
+    if not recent:
+        return
+    st.subheader("Jobs")
+    for job in recent:
+        files = job['params'].get('filenames') or [job['params'].get('filename', '')]
+        title = f"{JOB_LABELS.get(job['kind'], job['kind'])} · {', '.join(files[:3])}{' …' if len(files) > 3 else ''}"
+        with st.expander(f"{title} — {job['status']}", expanded=job['status'] != 'done' or job is recent[0]):
+            if job['status'] in ('queued', 'running'):
+                st.progress(job['progress'], text="Waiting..." if job['status'] == 'queued' else "Working...")
+                if job['partial']:
+                    st.markdown(job['partial'] + "▌")
+            elif job['status'] == 'failed':
+                st.error(f"AI request failed: {job['error']}")
+                if st.button("Retry", key=f"retry_{job['id']}"):
+                    jobs.retry(job['id'])
+                    st.rerun(scope="fragment")
+            elif job['result']:
+                st.markdown(job['result'])
+                st.download_button(" Download", job['result'],
+                                   f"{job['kind']}_{job['created_at'][5:16].replace(':', '')}.txt",
+                                   key=f"download_job_{job['id']}")
+
+
 # User setup with name login
 if 'user_id' not in st.session_state:
     username = st.text_input("Enter your username to continue:", placeholder="e.g.,  Giannis  ")
@@ -28,6 +129,7 @@ if 'user_id' not in st.session_state:
         user_id = hashlib.md5(username.lower().strip().encode()).hexdigest()[:16]
         st.session_state.user_id = user_id
         st.session_state.username = username
+        update_user(user_id, username.strip())
         st.rerun()
     else:
         st.info("Please enter your name to use the study system")
@@ -35,9 +137,8 @@ if 'user_id' not in st.session_state:
 
 user_id = st.session_state.user_id
 
-# Re-set user context on every run (important for memory mode)
+# The agents are shared by every browser session; this sets the user for this script run only
 planner.set_user(user_id)
-processor.set_user(user_id)
 
 st.title("Study System")
 
@@ -67,12 +168,10 @@ with st.sidebar:
         custom_style = st.text_input("Custom Style", value=current_style if current_style not in ["visual", "auditory",
                                                                                                   "reading"] else "")
         if custom_style and custom_style != current_style:
-            user['style'] = custom_style
-            state.set(f"user:{user_id}", user)
+            update_user(user_id, style=custom_style)
             st.rerun()
     elif style != current_style:
-        user['style'] = style
-        state.set(f"user:{user_id}", user)
+        update_user(user_id, style=style)
         st.rerun()
 
     st.write(f"**User:** {st.session_state.get('username', 'Unknown')}")
@@ -88,9 +187,14 @@ with st.sidebar:
     if stats["sessions"] > 0:
         st.subheader("Stats")
         st.write(f"**Sessions:** {stats['sessions']}")
+        st.write(f"**AI calls:** {stats['ai_calls']} ({stats['tokens']:,} tokens)")
+        st.write(f"**Time studied:** {stats['seconds'] / 3600:.1f} h")
 
 # Main interface
-tab1, tab2, tab3 = st.tabs(["📚 Study Planning", "📄 File Processing", "📝 Content Library"])
+tab_names = ["📚 Study Planning", "📄 File Processing", "📝 Content Library"]
+is_admin = st.session_state.get('username', '').strip().lower() in ADMIN_USERS
+tabs = st.tabs(tab_names + ["📈 Performance"] if is_admin else tab_names)
+tab1, tab2, tab3 = tabs[:3]
 
 with tab1:
     st.header("Create Study Plan")
@@ -120,110 +224,147 @@ with tab1:
     use_files = st.checkbox("Include processed files in plan")
 
     if st.button("Create Study Plan", type="primary", use_container_width=True) and subject and hours and deadline:
+        live = st.empty()
+        result = None
         with st.spinner("Creating your study plan..."):
             session_id = start_session(user_id, subject)
+            planner.set_user(user_id, session_id)
 
             # Enhanced prompt with additional fields
             enhanced_focus = f"{focus}, {topic}" if focus and topic else (focus or topic or "General")
             enhanced_goals = f"{goals}. Level: {difficulty}. Daily time: {daily_time or 'flexible'}."
 
-            if use_files:
-                result = planner.comprehensive_planning(subject, hours, deadline, enhanced_focus, enhanced_goals, [])
-            else:
-                result = planner.create_plan(subject, hours, deadline, enhanced_focus, enhanced_goals)
+            try:
+                if use_files:
+                    result = planner.comprehensive_planning(subject, hours, deadline, enhanced_focus, enhanced_goals,
+                                                            [], on_token=token_stream(live))
+                else:
+                    result = planner.create_plan(subject, hours, deadline, enhanced_focus, enhanced_goals,
+                                                 on_token=token_stream(live))
+            except LLMError as e:
+                st.error(f"AI request failed: {e}")
             end_session(session_id)
+        live.empty()
 
-        st.success("Study plan created!")
-        st.markdown("### Your Study Plan")
-        st.markdown(result)
-        st.download_button("Download", result, f"plan_{datetime.now().strftime('%m%d_%H%M')}.txt",
-                           use_container_width=True)
+        if result:
+            st.success("Study plan created!")
+            st.markdown("### Your Study Plan")
+            st.markdown(result)
+            st.download_button("Download", result, f"plan_{datetime.now().strftime('%m%d_%H%M')}.txt",
+                               use_container_width=True)
 
 with tab2:
     st.header("Process Files")
 
-    file = st.file_uploader("Upload file", type=['pdf', 'txt', 'docx'])
+    uploads = st.file_uploader("Upload files", type=['pdf', 'txt', 'docx'], accept_multiple_files=True)
 
-    if file:
-        with tempfile.NamedTemporaryFile(delete=False, suffix=f".{file.name.split('.')[-1]}") as tmp:
-            tmp.write(file.getvalue())
-            path = tmp.name
+    if uploads:
+        # Saved once under their content hash; reruns reuse the same paths and the jobs read them later
+        paths = [store_upload(f.name, f.getvalue()) for f in uploads]
+        names = [f.name for f in uploads]
 
-        col1, col2, col3 = st.columns(3)
-
-        if 'result' not in st.session_state:
-            st.session_state.result = None
+        if len(uploads) > 1:
+            if st.button(f" Add all {len(uploads)} files to library", use_container_width=True):
+                jobs.submit(user_id, "ingest", paths=paths, filenames=names)
+            index = st.selectbox("File", range(len(uploads)), format_func=lambda i: names[i])
+        else:
+            index = 0
+        path, name = paths[index], names[index]
 
+        col1, col2, col3 = st.columns(3)
         with col1:
             if st.button(" Summary", use_container_width=True):
-                session_id = start_session(user_id, "Processing")
-                st.session_state.result = processor.create_summary(path, "detailed", "medium", file.name)
-                end_session(session_id)
-
+                jobs.submit(user_id, "summary", path=path, filename=name)
         with col2:
             if st.button(" Notes", use_container_width=True):
-                session_id = start_session(user_id, "Processing")
-                st.session_state.result = processor.create_notes(path, "detailed", file.name)
-                end_session(session_id)
-
+                jobs.submit(user_id, "notes", path=path, filename=name)
         with col3:
             if st.button(" Questions", use_container_width=True):
-                session_id = start_session(user_id, "Processing")
-                st.session_state.result = processor.create_questions(path, "mixed", "medium", file.name)
-                end_session(session_id)
-
-        if st.session_state.result:
-            st.markdown("---")
-            st.markdown(st.session_state.result)
-            st.download_button(" Download", st.session_state.result,
-                               f"content_{datetime.now().strftime('%m%d_%H%M')}.txt")
+                jobs.submit(user_id, "questions", path=path, filename=name)
 
         # File-based plan
         st.markdown("---")
-        st.subheader("Create Plan from File")
+        st.subheader("Create Plan from Files")
         col4, col5 = st.columns(2)
         with col4:
             plan_hours = st.text_input("Study Hours")
         with col5:
             plan_deadline = st.text_input("Study Deadline")
 
-        if st.button(" Plan from File", use_container_width=True) and plan_hours and plan_deadline:
-            # use StudyPlanner with file context
-            session_id = start_session(user_id, "File Planning")
-            result = planner.comprehensive_planning("File Study", plan_hours, plan_deadline, "File Content",
-                                                    "Master content", [path])
-            end_session(session_id)
-            st.markdown("### File-Based Plan")
-            st.markdown(result)
-            st.download_button(" Download Plan", result,
-                               f"file_plan_{datetime.now().strftime('%m%d_%H%M')}.txt",
-                               use_container_width=True)
+        if st.button(" Plan from Files", use_container_width=True) and plan_hours and plan_deadline:
+            jobs.submit(user_id, "file_plan", paths=paths, filenames=names, hours=plan_hours,
+                        deadline=plan_deadline)
 
-        os.unlink(path)
+    st.markdown("---")
+    job_panel(user_id)
 
 with tab3:
     st.header("Your Library")
 
-    content = get_user_content(user_id, 50)
-
-    if content:
-        # Group content by filename
-        files = {}
-        for item in content:
-            filename = item['filename']
-            if filename not in files:
-                files[filename] = []
-            files[filename].append(item)
-
-        # Display each file and its content
-        for filename, items in files.items():
-            with st.expander(f"📄 {filename} ({len(items)} items)"):
-                for item in items:
-                    st.markdown(f"**{item['type'].title()}** - {item['created'][:16]}")
-                    st.write(item['content'][:150] + "..." if len(item['content']) > 150 else item['content'])
-                    st.download_button(f"Download {item['type']}", item['content'],
-                                       f"{item['type']}_{filename}_{item['created'][:10]}.txt",
-                                       key=item['id'])
-                    st.markdown("---")
+    query = st.text_input("Search your library", placeholder="e.g., mitochondria, chapter 3, questions")
+    page_size = 20
+
+    if query:
+        if st.session_state.get('search_query') != query:
+            st.session_state.search_query = query
+            st.session_state.search_page = 0
+        page = st.session_state.search_page
+
+        hits = search_content(user_id, query, page_size, page * page_size)
+        if hits:
+            for hit in hits:
+                st.markdown(f"**{hit['filename']}** · {hit['type'].title()} · {hit['created'][:16]}")
+                st.markdown(hit['snippet'])
+                open_item(hit['id'], f"search_{hit['id']}")
+                st.markdown("---")
+        else:
+            st.info("No matches.")
+
+        col_prev, col_next = st.columns(2)
+        with col_prev:
+            if page > 0 and st.button("◀ Previous", use_container_width=True):
+                st.session_state.search_page -= 1
+                st.rerun()
+        with col_next:
+            if len(hits) == page_size and st.button("Next ▶", use_container_width=True):
+                st.session_state.search_page += 1
+                st.rerun()
     else:
-        st.info("No content saved yet. Process some files to build your library!")
+        # Keyset paging over metadata rows; bodies are only loaded for opened items
+        cursors = st.session_state.setdefault('library_cursors', [None])
+        content, next_cursor = get_user_content_page(user_id, 50, cursors[-1])
+
+        if content:
+            # Group content by filename
+            files = {}
+            for item in content:
+                filename = item['filename']
+                if filename not in files:
+                    files[filename] = []
+                files[filename].append(item)
+
+            # Display each file and its content
+            for filename, items in files.items():
+                with st.expander(f"📄 {filename} ({len(items)} items)"):
+                    for item in items:
+                        st.markdown(f"**{item['type'].title()}** - {item['created'][:16]}")
+                        st.write(item['preview'] + "..." if item['length'] > len(item['preview']) else item['preview'])
+                        open_item(item['id'], item['id'])
+                        st.markdown("---")
+
+            col_prev, col_next = st.columns(2)
+            with col_prev:
+                if len(cursors) > 1 and st.button("◀ Newer", use_container_width=True):
+                    cursors.pop()
+                    st.rerun()
+            with col_next:
+                if next_cursor and st.button("Older ▶", use_container_width=True):
+                    cursors.append(next_cursor)
+                    st.rerun()
+        else:
+            st.info("No content saved yet. Process some files to build your library!")
+
+if is_admin:
+    with tabs[3]:
+        st.header("Performance")
+        performance_panel()
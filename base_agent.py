@@ -1,64 +1,241 @@
-import os
-from dotenv import load_dotenv
-import openai
+import contextvars
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
 from SQLiteState import *
+from llm_backends import create_client
+from llm_cache import llm_cache, single_flight
+from llm_scheduler import LLMError, scheduler
+from retrieval_index import retriever
+from chunking import estimate_tokens
+from metrics import metrics
+
+
+# Who the current request is for. Agents are shared by every Streamlit session,
+# so this lives in the caller's context rather than on the agent instance.
+_user_id = contextvars.ContextVar("user_id", default=None)
+_session_id = contextvars.ContextVar("session_id", default=None)
+
+
+@contextmanager
+def user_context(user_id: str, session_id: str = None):
+    """Run the enclosed agent calls on behalf of user_id, logging to session_id"""
+    tokens = (_user_id.set(user_id), _session_id.set(session_id))
+    try:
+        yield
+    finally:
+        _session_id.reset(tokens[1])
+        _user_id.reset(tokens[0])
 
 
 class BaseAgent:
-    def __init__(self, name: str):
-        load_dotenv()
+    model = "deepseek/deepseek-chat-v3-0324:free"
+    temperature = 0.7
+    max_concurrency = 4
+    # USD per million prompt / completion tokens, for the cost estimate; the default model is free
+    prices = (0.0, 0.0)
+
+    def __init__(self, name: str, use_cache: bool = True, client=None):
         self.name = name
-        self.current_user_id = None
-        self.current_session_id = None
+        self.use_cache = use_cache
 
-        api_key = os.getenv("OPENROUTER_API_KEY")
-        if not api_key:
+        # Any object with chat.completions.create works; see llm_backends
+        self.client = client or create_client()
+        if not self.client:
             print(f" OPENROUTER_API_KEY not found for {name}")
-            self.client = None
-        else:
-            self.client = openai.OpenAI(api_key=api_key, base_url="https://openrouter.ai/api/v1")
 
-    def set_user(self, user_id: str):
-        """Set current user"""
-        self.current_user_id = user_id
-        self.current_session_id = state.get(f"current_session:{user_id}")
+    @property
+    def current_user_id(self):
+        return _user_id.get()
+
+    @property
+    def current_session_id(self):
+        return _session_id.get()
+
+    def set_user(self, user_id: str, session_id: str = None):
+        """Set the user (and session, default: their latest) for the rest of the
+        current context: the Streamlit script run or job that calls it"""
+        _user_id.set(user_id)
+        _session_id.set(session_id or state.get(f"current_session:{user_id}"))
 
-    def call_ai(self, prompt: str, max_tokens: int = 800) -> str:
-        """AI call with user context"""
+    def call_ai(self, prompt: str, max_tokens: int = 800, on_token=None) -> str:
+        """AI call with user context. With on_token, the response is streamed
+        and on_token(delta) is called as each piece arrives.
+
+        Goes through the shared scheduler; raises LLMError if the call fails.
+        """
         if not self.client:
-            return "AI client not available - check OPENROUTER_API_KEY"
+            raise LLMError("AI client not available - check OPENROUTER_API_KEY")
+
+        context = self._with_user_context(prompt)
+        cache_key = llm_cache.make_key(self.model, context, max_tokens, self.temperature)
+        cached = self._cached(cache_key)
+        if cached is not None:
+            if on_token:
+                on_token(cached)
+            return cached
 
-        if self.current_user_id:
-            user = state.get(f"user:{self.current_user_id}", {})
-            context = f"""User Context:
+        def fetch():
+            with metrics.span("llm.call", agent=self.name) as span:
+                timing, usage = {"begin": time.perf_counter()}, {}
+                if on_token:
+                    parts = []
+                    for delta in self._stream(context, max_tokens, usage, timing):
+                        parts.append(delta)
+                        on_token(delta)
+                    result = "".join(parts)
+                else:
+                    def create():
+                        timing["sent"] = time.perf_counter()
+                        return self.client.chat.completions.create(
+                            model=self.model,
+                            messages=[{"role": "user", "content": context}],
+                            max_tokens=max_tokens,
+                            temperature=self.temperature
+                        )
+                    response = scheduler.run(create)
+                    result = response.choices[0].message.content
+                    usage.update(_usage(getattr(response, "usage", None)))
+                tokens = self._measure(span, timing, usage, context, result)
+            self._record(cache_key, result, tokens)
+            return result
+
+        # Identical requests already in flight (double clicks, other sessions) share one call
+        start = time.perf_counter()
+        result, shared = single_flight.do(cache_key, fetch)
+        if shared:
+            # How long a merged call waited for the one it shared
+            metrics.record("llm.coalesced", time.perf_counter() - start, agent=self.name)
+            if on_token:
+                on_token(result)
+            if self.current_session_id:
+                log_activity(self.current_session_id, f"{self.name}: AI call (shared)", tokens=0)
+        return result
+
+    def _measure(self, span, timing, usage, context, result):
+        """Fill in an llm.call span, record its queue wait and time to first token,
+        and return the tokens it used"""
+        metrics.record("llm.queue", timing["sent"] - timing["begin"], agent=self.name)
+        if "first" in timing:
+            metrics.record("llm.first_token", timing["first"] - timing["sent"], agent=self.name)
+        # Providers that don't report usage get an estimate
+        prompt = usage.get("prompt_tokens") or estimate_tokens(context)
+        completion = usage.get("completion_tokens") or estimate_tokens(result)
+        span.update(prompt_tokens=prompt, completion_tokens=completion,
+                    cost_usd=(prompt * self.prices[0] + completion * self.prices[1]) / 1_000_000)
+        return usage.get("total_tokens") or prompt + completion
+
+    def _with_user_context(self, prompt: str) -> str:
+        if not self.current_user_id:
+            return prompt
+        user = get_user(self.current_user_id)
+        return f"""User Context:
 Learning Style: {user.get('style', 'visual')}
 Agent: {self.name}
 
 User Request: {prompt}"""
-        else:
-            context = prompt
 
-        try:
-            response = self.client.chat.completions.create(
-                model="deepseek/deepseek-chat-v3-0324:free",
+    def _stream(self, context: str, max_tokens: int, usage: dict = None, timing: dict = None):
+        """Yield content deltas from the streaming completions API, filling
+        `usage` from the final chunk when the provider reports it, and
+        `timing` with when the request was sent and its first token arrived.
+
+        Only opening the stream is retried; once tokens have been handed out,
+        a failure is raised as LLMError.
+        """
+        timing = {} if timing is None else timing
+
+        def create():
+            timing["sent"] = time.perf_counter()
+            return self.client.chat.completions.create(
+                model=self.model,
                 messages=[{"role": "user", "content": context}],
                 max_tokens=max_tokens,
-                temperature=0.7
+                temperature=self.temperature,
+                stream=True,
+                stream_options={"include_usage": True}
             )
 
-            result = response.choices[0].message.content
+        stream = scheduler.run(create, hold=True)
+        try:
+            for chunk in stream:
+                if usage is not None and getattr(chunk, "usage", None):
+                    usage.update(_usage(chunk.usage))
+                if chunk.choices and chunk.choices[0].delta.content:
+                    timing.setdefault("first", time.perf_counter())
+                    yield chunk.choices[0].delta.content
+        except Exception as e:
+            raise LLMError(f"Stream interrupted: {e}") from e
+        finally:
+            # Frees the scheduler slot even if the caller stops reading early
+            stream.close()
 
-            # Log activity if in session
-            if self.current_session_id:
-                log_activity(self.current_session_id, f"{self.name}: AI call")
+    def _cached(self, cache_key: str):
+        if not self.use_cache:
+            return None
+        cached = llm_cache.get(cache_key)
+        if cached is not None:
+            metrics.record("llm.cached", 0.0, agent=self.name)
+        if cached is not None and self.current_session_id:
+            log_activity(self.current_session_id, f"{self.name}: AI call (cached)", tokens=0)
+        return cached
 
-            return result
+    def _record(self, cache_key: str, result: str, tokens: int):
+        """Cache and log a completed AI call with the tokens it used"""
+        if self.use_cache:
+            llm_cache.put(cache_key, result)
 
-        except Exception as e:
-            return f"Error: {str(e)}"
+        # Log activity if in session
+        if self.current_session_id:
+            log_activity(self.current_session_id, f"{self.name}: AI call", tokens)
+
+    def save_result(self, filename: str, content_type: str, content: str, user_id: str = None):
+        """Save generated content to the user's library and retrieval index"""
+        user_id = user_id or self.current_user_id
+        content_id = save_content(user_id, filename, content_type, content)
+        retriever.add_document(user_id, content_id, filename, content_type, content)
+        return content_id
+
+    def run_parallel(self, tasks: list, max_workers: int = None) -> list:
+        """Run independent callables on a bounded thread pool.
+
+        Results come back in the order of `tasks`; a task that raises yields
+        its exception in place instead of failing the others.
+        """
+        workers = min(max_workers or self.max_concurrency, len(tasks))
+        if workers <= 1:
+            futures = [_run_inline(task) for task in tasks]
+        else:
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix=self.name) as pool:
+                # Copy the caller's context so settings like the scheduler lane carry over
+                futures = [pool.submit(contextvars.copy_context().run, task) for task in tasks]
+
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                results.append(e)
+        return results
 
     def send_message(self, to_agent: str, message: str):
         """Send message to another agent"""
         if self.current_session_id:
             log_activity(self.current_session_id, f"Message to {to_agent}: {message}")
         print(f" {self.name} → {to_agent}: {message}")
+
+
+def _usage(usage):
+    """Token counts from a response's usage, as a dict without the ones it lacks"""
+    counts = {name: getattr(usage, name, None) for name in ("prompt_tokens", "completion_tokens", "total_tokens")}
+    return {name: count for name, count in counts.items() if count is not None}
+
+
+def _run_inline(task):
+    """Run a task now, wrapped in a completed Future"""
+    future = Future()
+    try:
+        future.set_result(task())
+    except Exception as e:
+        future.set_exception(e)
+    return future
@@ -0,0 +1,673 @@
+"""Micro-benchmarks for the study system.
+
+Run from the project root, e.g.:
+
+    python benchmark.py state --threads 1 8 32
+    python benchmark.py planning --files 4 --latency 1.0
+    python benchmark.py extract --pages 500
+    python benchmark.py search --items 100000
+    python benchmark.py retrieval --chunks 1000000
+    python benchmark.py library --items 10000
+    python benchmark.py context --threads 32
+    python benchmark.py cache --users 100
+    python benchmark.py writes --threads 1 8 32
+    python benchmark.py startup --workers 1 4 8
+    python benchmark.py --json results.json suite
+"""
+import argparse
+import json
+import multiprocessing
+import itertools
+import os
+import platform
+import random
+import re
+import resource
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+
+from llm_backends import FakeLLM, RecordingLLM, serve
+from SQLiteState import (SQLiteState, end_session, get_session_activities, get_user_content, start_session,
+                         state, update_user)
+
+
+class LegacyState(SQLiteState):
+    """Pre-pooling connection behaviour: rollback journal, a fresh connection per call, one global lock"""
+
+    def __init__(self, db_path):
+        self._global_lock = threading.RLock()
+        super().__init__(db_path)
+
+    def get_connection(self):
+        conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def init_db(self):
+        super().init_db()
+        with self.connection() as conn:
+            conn.execute('PRAGMA journal_mode=DELETE')
+
+    @contextmanager
+    def connection(self):
+        with self._global_lock:
+            conn = self.get_connection()
+            try:
+                yield conn
+            finally:
+                conn.close()
+
+
+@contextmanager
+def temp_state():
+    """Point the global state, and so the agents, at a throwaway database for the block"""
+    with tempfile.TemporaryDirectory() as tmp:
+        previous = state.use(lambda: SQLiteState(Path(tmp) / "bench.db", write_mode="behind"))
+        try:
+            yield
+        finally:
+            state.use(previous)
+
+
+def _state_worker(db, worker_id, ops, barrier):
+    barrier.wait()
+    for i in range(ops):
+        key = f"bench:{worker_id}:{i % 10}"
+        if i % 4 == 0:
+            db.set(key, {"worker": worker_id, "i": i})
+        elif i % 4 == 1:
+            db.push(f"bench_list:{worker_id}", {"i": i}, max_items=50)
+        elif i % 4 == 2:
+            db.get(key)
+        else:
+            db.get_list(f"bench_list:{worker_id}", 20)
+
+
+def bench_state(threads, ops):
+    """ops/sec for a mixed set/get/push/get_list workload"""
+    results = []
+    for label, factory in (("legacy", LegacyState), ("pooled", SQLiteState)):
+        for n in threads:
+            with tempfile.TemporaryDirectory() as tmp:
+                db = factory(Path(tmp) / "bench.db")
+                barrier = threading.Barrier(n + 1)
+                workers = [threading.Thread(target=_state_worker, args=(db, w, ops, barrier))
+                           for w in range(n)]
+                for w in workers:
+                    w.start()
+                barrier.wait()
+                start = time.perf_counter()
+                for w in workers:
+                    w.join()
+                elapsed = time.perf_counter() - start
+                db.close()
+            rate = n * ops / elapsed
+            results.append({"impl": label, "threads": n, "ops_per_sec": round(rate, 1)})
+            print(f"{label:>7} threads={n:<3} {rate:10.1f} ops/sec")
+    return results
+
+
+def bench_cache(users, clicks, write_every):
+    """Reads behind one Summary click (3 profile reads and the current-session pointer), with and
+    without the read cache; every `write_every` clicks a user changes style or starts a session"""
+    results = []
+    for label, policies in (("uncached", {}), ("cached", None)):
+        with tempfile.TemporaryDirectory() as tmp:
+            db = SQLiteState(Path(tmp) / "bench.db", **({} if policies is None else {"cache_policies": policies}))
+            for u in range(users):
+                db.store_user(f"user-{u}", f"user{u}")
+                db.set(f"current_session:user-{u}", f"session-{u}")
+            rng = random.Random(0)
+            start = time.perf_counter()
+            for click in range(clicks):
+                user_id = f"user-{rng.randrange(users)}"
+                if write_every and click % write_every == 0:
+                    db.store_user(user_id, learning_style=rng.choice(["visual", "auditory", "reading"]))
+                    db.set(f"current_session:{user_id}", f"session-{click}")
+                db.get(f"current_session:{user_id}")
+                for _ in range(3):
+                    db.get_user(user_id)
+            elapsed = time.perf_counter() - start
+            stats = db.cache_stats()
+            db.close()
+        rate = clicks / elapsed
+        hits = sum(p["hits"] for p in stats["prefixes"].values())
+        misses = sum(p["misses"] for p in stats["prefixes"].values())
+        hit_rate = hits / max(hits + misses, 1)
+        results.append({"mode": label, "users": users, "clicks_per_sec": round(rate, 1),
+                        "hit_rate": round(hit_rate, 3)})
+        print(f"{label:>9} users={users:<5} {rate:10.1f} clicks/sec  hit rate {hit_rate:.1%}")
+    return results
+
+
+def _writes_worker(db, user, clicks, barrier):
+    barrier.wait()
+    for click in range(clicks):
+        # The small writes around one plan: session pointer, activities and list entries
+        db.set(f"current_session:{user}", f"session-{click}")
+        for step in range(3):
+            db.add_activity(f"session-{click}", f"step {step}", 100)
+        db.push(f"recent:{user}", {"click": click})
+        db.set(f"last_plan:{user}", {"click": click, "subject": "Benchmarking"})
+
+
+def bench_writes(threads, clicks, synchronous):
+    """Small-write throughput per write mode, each thread a user clicking; includes the final flush"""
+    results = []
+    for mode in ("immediate", "group", "behind"):
+        for n in threads:
+            with tempfile.TemporaryDirectory() as tmp:
+                db = SQLiteState(Path(tmp) / "bench.db", synchronous=synchronous, write_mode=mode)
+                barrier = threading.Barrier(n + 1)
+                workers = [threading.Thread(target=_writes_worker, args=(db, f"user-{w}", clicks, barrier))
+                           for w in range(n)]
+                for w in workers:
+                    w.start()
+                barrier.wait()
+                start = time.perf_counter()
+                for w in workers:
+                    w.join()
+                db.flush()
+                elapsed = time.perf_counter() - start
+                db.close()
+            rate = n * clicks * 6 / elapsed
+            results.append({"mode": mode, "synchronous": synchronous, "threads": n,
+                            "writes_per_sec": round(rate, 1)})
+            print(f"{mode:>9} threads={n:<3} {rate:10.1f} writes/sec")
+    return results
+
+
+STARTUP_MODULES = ["SQLiteState", "base_agent", "content_processor_agent", "study_planner_agent", "job_queue"]
+# Loaded only on first use; timed for reference
+DEFERRED_MODULES = ["numpy", "PyPDF2", "docx", "openai", "dotenv"]
+
+
+def _import_time(module, cwd):
+    """Cumulative microseconds `python -X importtime` reports for importing module in a fresh process"""
+    env = {**os.environ, "PYTHONPATH": os.pathsep.join(filter(None, [os.getcwd(), os.getenv("PYTHONPATH")]))}
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"], cwd=cwd, env=env,
+                            capture_output=True, text=True)
+    if result.returncode:
+        return None
+    for line in result.stderr.splitlines():
+        parts = line.split("|")
+        if len(parts) == 3 and parts[2].strip() == module:
+            return int(parts[1])
+    return None
+
+
+def bench_startup(workers, repeat=3):
+    """Import time of the app's modules (best of `repeat` fresh processes), whether importing
+    them wrote anything to disk, and how long a spawned extraction pool takes to come up"""
+    from content_processor_agent import _extract_file
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for module in STARTUP_MODULES + DEFERRED_MODULES:
+            times = [t for t in (_import_time(module, tmp) for _ in range(repeat)) if t is not None]
+            if not times:
+                print(f"{module:>24}: not importable")
+                continue
+            kind = "deferred" if module in DEFERRED_MODULES else "startup"
+            results.append({"module": module, "kind": kind, "import_ms": round(min(times) / 1000, 1)})
+            print(f"{module:>24}: {min(times) / 1000:7.1f} ms ({kind})")
+        side_effects = sorted(os.listdir(tmp))
+        print(f"files created by imports: {side_effects or 'none'}")
+        results.append({"files_created_by_imports": side_effects})
+
+        path = Path(tmp) / "reading.txt"
+        path.write_text("Chapter 1\n" + "Lorem ipsum dolor sit amet. " * 50, encoding="utf-8")
+        # Spawned workers start from a fresh interpreter and import the agents, as on macOS and Windows
+        context = multiprocessing.get_context("spawn")
+        for n in workers:
+            start = time.perf_counter()
+            with ProcessPoolExecutor(max_workers=n, mp_context=context) as pool:
+                list(pool.map(_extract_file, [str(path)] * n * 2))
+            elapsed = time.perf_counter() - start
+            results.append({"workers": n, "pool_seconds": round(elapsed, 3)})
+            print(f"spawn pool workers={n:<3} {elapsed:6.2f}s to start, extract and shut down")
+    return results
+
+
+def bench_planning(files, latency, backend="inproc"):
+    """Wall-clock time of comprehensive_planning, one worker vs the default fan-out.
+
+    backend "inproc" calls FakeLLM directly; "http" goes through the openai
+    client to FakeLLM served locally, so client and HTTP overhead are included.
+    """
+    from study_planner_agent import StudyPlannerAgent
+    from content_processor_agent import ContentProcessorAgent
+    from llm_scheduler import scheduler
+
+    # Measure the agents, not the free-tier rate limit
+    scheduler.rate = scheduler.burst = 1000
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = []
+        for i in range(files):
+            path = Path(tmp) / f"reading_{i}.txt"
+            path.write_text(f"Chapter {i}\n" + "Lorem ipsum dolor sit amet. " * 200, encoding="utf-8")
+            paths.append(str(path))
+
+        fake = FakeLLM(latency)
+        server = None
+        if backend == "http":
+            import openai
+            server = serve(fake, port=0)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            client = openai.OpenAI(api_key="local", base_url=f"http://127.0.0.1:{server.server_port}/v1",
+                                   max_retries=0)
+        else:
+            client = fake
+
+        for label, workers in (("sequential", 1), ("parallel", StudyPlannerAgent.max_concurrency)):
+            planner = StudyPlannerAgent(client)
+            processor = ContentProcessorAgent(client)
+            planner.register_content_processor(processor)
+            for agent in (planner, processor):
+                agent.use_cache = False
+                agent.max_concurrency = workers
+
+            # A fresh database per mode, so nothing the first stored is reused by the second
+            with temp_state():
+                start = time.perf_counter()
+                planner.comprehensive_planning("Benchmarking", "10 hours", "next week", "all", "finish", paths)
+                elapsed = time.perf_counter() - start
+            results.append({"mode": label, "backend": backend, "files": files, "seconds": round(elapsed, 3)})
+            print(f"{label:>10} files={files} {elapsed:6.2f}s")
+        if server:
+            server.shutdown()
+    return results
+
+
+def write_synthetic_pdf(path, pages, lines_per_page=40):
+    """Minimal multi-page PDF with plain Helvetica text, no dependencies needed"""
+    objects = ["<< /Type /Catalog /Pages 2 0 R >>", None,
+               "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    kids = []
+    for page in range(pages):
+        lines = [f"Page {page + 1} line {i}: the quick brown fox jumps over the lazy dog" for i in range(lines_per_page)]
+        text = " T* ".join(f"({line}) Tj" for line in lines)
+        stream = f"BT /F1 10 Tf 12 TL 50 780 Td {text} ET"
+        objects.append(f"<< /Length {len(stream)} >>\nstream\n{stream}\nendstream")
+        objects.append(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+                       f"/Resources << /Font << /F1 3 0 R >> >> /Contents {len(objects)} 0 R >>")
+        kids.append(f"{len(objects)} 0 R")
+    objects[1] = f"<< /Type /Pages /Kids [{' '.join(kids)}] /Count {pages} >>"
+
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(out))
+        out += f"{number} 0 obj\n{body}\nendobj\n".encode("latin-1")
+    xref = len(out)
+    out += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode()
+    out += "".join(f"{offset:010d} 00000 n \n" for offset in offsets).encode()
+    out += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode()
+    Path(path).write_bytes(out)
+
+
+def _extract_worker(path, workers, results):
+    from content_processor_agent import iter_pages
+
+    start = time.perf_counter()
+    pages = sum(1 for _ in iter_pages(path, workers=workers))
+    elapsed = time.perf_counter() - start
+    peak_kb = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+               + resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    results.put((pages, elapsed, peak_kb))
+
+
+def bench_extract(pages, workers):
+    """pages/sec and peak RSS of PDF extraction, in-process vs the process pool"""
+    results = []
+    ctx = multiprocessing.get_context("spawn")
+    with tempfile.TemporaryDirectory() as tmp:
+        path = str(Path(tmp) / "synthetic.pdf")
+        write_synthetic_pdf(path, pages)
+        for label, n in (("sequential", 1), ("pool", workers)):
+            # Fresh process per mode so peak RSS isn't carried over
+            queue = ctx.Queue()
+            proc = ctx.Process(target=_extract_worker, args=(path, n, queue))
+            proc.start()
+            count, elapsed, peak_kb = queue.get()
+            proc.join()
+            rate = count / elapsed
+            results.append({"mode": label, "pages": count, "pages_per_sec": round(rate, 1),
+                            "peak_rss_mb": round(peak_kb / 1024, 1)})
+            print(f"{label:>10} pages={count} {rate:8.1f} pages/sec  peak RSS {peak_kb / 1024:.1f} MB")
+    return results
+
+
+def _percentiles(samples):
+    ordered = sorted(samples)
+    return {"p50": ordered[len(ordered) // 2], "p95": ordered[int(len(ordered) * 0.95) - 1]}
+
+
+def _synthetic_items(user_id, items, rng, vocabulary, weights, words):
+    for i in range(items):
+        yield {"id": f"{user_id}-{i}", "user": user_id, "filename": f"file{i % 500}.pdf",
+               "type": rng.choice(["summary", "notes", "questions"]),
+               "content": " ".join(rng.choices(vocabulary, cum_weights=weights, k=words)),
+               "created": f"2025-01-01T00:00:00.{i:06d}"}
+
+
+def _fill_library(db, user_id, items, rng, vocabulary, weights, words):
+    """Insert synthetic content items straight through the state's insert path, 5000 per transaction"""
+    generated = _synthetic_items(user_id, items, rng, vocabulary, weights, words)
+    for _ in range(0, items, 5000):
+        with db.transaction() as conn:
+            for item in itertools.islice(generated, 5000):
+                db._insert_content(conn, item)
+
+
+def _db_size(db_path):
+    conn = sqlite3.connect(db_path)
+    conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    conn.close()
+    return Path(db_path).stat().st_size
+
+
+def bench_library(items, words):
+    """Content Library page load and DB size: inline text vs compressed bodies"""
+    vocabulary = [f"word{i}" for i in range(5000)]
+    weights = list(itertools.accumulate(1 / (rank + 1) for rank in range(len(vocabulary))))
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        # Layout before bodies were split out: full text in the content row and in the FTS table
+        inline_path = Path(tmp) / "inline.db"
+        conn = sqlite3.connect(inline_path)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('''CREATE TABLE content (id TEXT PRIMARY KEY, user_id TEXT NOT NULL, filename TEXT,
+                                               type TEXT, content TEXT, created_at TEXT)''')
+        conn.execute('CREATE INDEX idx_content_user_created ON content (user_id, created_at)')
+        conn.execute('CREATE VIRTUAL TABLE content_fts USING fts5(user_id, filename, type, content, '
+                     'content_id UNINDEXED, created UNINDEXED)')
+        with conn:
+            for item in _synthetic_items("user0", items, random.Random(0), vocabulary, weights, words):
+                row = (item["id"], item["user"], item["filename"], item["type"], item["content"], item["created"])
+                conn.execute('INSERT INTO content VALUES (?, ?, ?, ?, ?, ?)', row)
+                conn.execute('INSERT INTO content_fts VALUES (?, ?, ?, ?, ?, ?)', row[1:5] + (row[0], row[5]))
+        conn.row_factory = sqlite3.Row
+
+        def inline_page():
+            rows = conn.execute('''SELECT * FROM content WHERE user_id = ?
+                                   ORDER BY created_at DESC LIMIT 50''', ("user0",)).fetchall()
+            return [row['content'][:150] for row in rows]
+
+        compressed_path = Path(tmp) / "compressed.db"
+        db = SQLiteState(compressed_path)
+        _fill_library(db, "user0", items, random.Random(0), vocabulary, weights, words)
+
+        def compressed_page():
+            items_, _ = db.list_content_page("user0", 50)
+            return [item['preview'] for item in items_]
+
+        for label, page, path in (("inline", inline_page, inline_path),
+                                  ("compressed", compressed_page, compressed_path)):
+            page()
+            samples = []
+            for _ in range(200):
+                start = time.perf_counter()
+                page()
+                samples.append((time.perf_counter() - start) * 1000)
+            stats = _percentiles(samples)
+            size = _db_size(path)
+            results.append({"layout": label, "items": items, "db_bytes": size, **stats})
+            print(f"{label:>10}: DB {size / 1024 / 1024:7.1f} MB  library page p50 {stats['p50']:.2f} ms"
+                  f"  p95 {stats['p95']:.2f} ms")
+
+        samples = []
+        for i in range(200):
+            start = time.perf_counter()
+            db.get_content(f"user0-{i * 37 % items}")
+            samples.append((time.perf_counter() - start) * 1000)
+        stats = _percentiles(samples)
+        print(f"{'open item':>10}: p50 {stats['p50']:.2f} ms  p95 {stats['p95']:.2f} ms")
+        conn.close()
+        db.close()
+    return results
+
+
+def bench_search(items, users):
+    """Full-text search latency over a library of `items` items per user"""
+    rng = random.Random(0)
+    vocabulary = [f"term{i}" for i in range(20000)]
+    # Zipf-like weights so there are very common and very rare words
+    weights = list(itertools.accumulate(1 / (rank + 1) for rank in range(len(vocabulary))))
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        db = SQLiteState(Path(tmp) / "bench.db")
+        start = time.perf_counter()
+        for u in range(users):
+            _fill_library(db, f"user{u}", items, rng, vocabulary, weights, 120)
+        print(f"indexed {items * users} items in {time.perf_counter() - start:.1f}s")
+
+        queries = {"common term": "term1", "rare term": "term15000", "two terms": "term3 term40",
+                   "prefix": "term1234*", "filename": "file42"}
+        for label, query in queries.items():
+            samples = []
+            for _ in range(30):
+                start = time.perf_counter()
+                db.search_content("user0", query, 20)
+                samples.append((time.perf_counter() - start) * 1000)
+            stats = _percentiles(samples)
+            results.append({"query": label, "items": items, **stats})
+            print(f"{label:>12}: p50 {stats['p50']:.2f} ms  p95 {stats['p95']:.2f} ms")
+        db.close()
+    return results
+
+
+def bench_retrieval(chunks):
+    """BM25 top-k latency over an in-memory index of `chunks` chunks"""
+    from retrieval_index import BM25Index
+
+    rng = random.Random(0)
+    vocabulary = [f"term{i}" for i in range(20000)]
+    weights = list(itertools.accumulate(1 / (rank + 1) for rank in range(len(vocabulary))))
+    index = BM25Index()
+    start = time.perf_counter()
+    for i in range(chunks):
+        index.add({"source": f"file{i % 500}.pdf", "kind": "file",
+                   "text": " ".join(rng.choices(vocabulary, cum_weights=weights, k=60))})
+    index.search("term1")
+    print(f"indexed {chunks} chunks in {time.perf_counter() - start:.1f}s")
+
+    results = []
+    queries = {"common term": "term1", "rare term": "term15000", "plan query": "term3 term40 term512 term7000"}
+    for label, query in queries.items():
+        samples = []
+        for _ in range(30):
+            start = time.perf_counter()
+            index.search(query, 20)
+            samples.append((time.perf_counter() - start) * 1000)
+        stats = _percentiles(samples)
+        results.append({"query": label, "chunks": chunks, **stats})
+        print(f"{label:>12}: p50 {stats['p50']:.2f} ms  p95 {stats['p95']:.2f} ms")
+    return results
+
+
+def _context_worker(planner, i, plans, barrier, errors):
+    from base_agent import user_context
+
+    user_id = f"bench-context-{i}"
+    update_user(user_id, f"bench{i}", f"style-{i}")
+    barrier.wait()
+    for _ in range(plans):
+        session_id = start_session(user_id, f"Subject {i}")
+        with user_context(user_id, session_id):
+            planner.create_plan(f"Subject {i}", "5 hours", "next week", "all", "pass")
+        end_session(session_id)
+        activities = get_session_activities(session_id)
+        if len(activities) != 1:
+            errors.append(f"session {session_id} of {user_id} logged {len(activities)} activities, expected 1")
+
+
+def bench_context(threads, plans, latency):
+    """Many users' plans on one shared planner at once, checking nothing crosses between them.
+
+    Every prompt must carry only its own user's learning style and history,
+    every session only its own activities, every library only its own plans.
+    """
+    from study_planner_agent import StudyPlannerAgent
+    from llm_scheduler import scheduler
+
+    scheduler.rate = scheduler.burst = 1000
+    results = []
+    for label, n in (("sequential", 1), ("concurrent", threads)):
+        fake = RecordingLLM(latency)
+        planner = StudyPlannerAgent(fake)
+        planner.use_cache = False
+        errors, barrier = [], threading.Barrier(n)
+        with temp_state():
+            start = time.perf_counter()
+            workers = [threading.Thread(target=_context_worker, args=(planner, i, plans, barrier, errors))
+                       for i in range(n)]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            elapsed = time.perf_counter() - start
+
+            for prompt in fake.prompts:
+                subject = re.search(r"study plan for Subject (\d+)", prompt).group(1)
+                styles = set(re.findall(r"Learning Style: style-(\d+)", prompt))
+                recent = re.search(r"Recent study subjects: (.*)", prompt)
+                recent = set(re.findall(r"Subject (\d+)", recent.group(1))) if recent else set()
+                if styles != {subject} or not recent <= {subject}:
+                    errors.append(f"prompt for Subject {subject} has styles {styles} and history {recent}")
+            for i in range(n):
+                foreign = [item["filename"] for item in get_user_content(f"bench-context-{i}", 1000)
+                           if item["filename"] != f"Study Plan - Subject {i}"]
+                if foreign:
+                    errors.append(f"bench-context-{i} has other users' content: {foreign[:3]}")
+
+        rate = n * plans / elapsed
+        results.append({"mode": label, "threads": n, "plans": n * plans, "seconds": round(elapsed, 3),
+                        "plans_per_sec": round(rate, 1), "bleed": len(errors)})
+        print(f"{label:>10} threads={n:<3} {rate:8.1f} plans/sec  cross-user bleed: {len(errors)}")
+        for error in errors[:5]:
+            print(f"           {error}")
+    return results
+
+
+def bench_suite():
+    """A quick pass over every layer, sized to finish in a few minutes"""
+    return {
+        "state": bench_state([1, 8], 200),
+        "extract": bench_extract(100, None),
+        "planning": bench_planning(4, 0.2),
+        "planning_http": bench_planning(4, 0.2, "http"),
+        "library": bench_library(2000, 500),
+        "search": bench_search(20000, 1),
+        "context": bench_context(16, 3, 0.05),
+        "cache": bench_cache(100, 20000, 50),
+        "writes": bench_writes([1, 8], 100, "FULL"),
+        "startup": bench_startup([1, 4]),
+    }
+
+
+def write_json(path, name, results):
+    """Save results with enough context to compare runs across commits"""
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                                text=True).stdout.strip() or None
+    except OSError:
+        commit = None
+    report = {"benchmark": name, "timestamp": datetime.now().isoformat(timespec="seconds"), "commit": commit,
+              "python": platform.python_version(), "platform": platform.platform(),
+              "cpus": os.cpu_count(), "results": results}
+    Path(path).write_text(json.dumps(report, indent=2), encoding="utf-8")
+    print(f"Wrote {path}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--json", metavar="PATH", help="also write the results to PATH as JSON")
+    sub = parser.add_subparsers(dest="bench", required=True)
+
+    p = sub.add_parser("state", help="SQLiteState throughput at several thread counts")
+    p.add_argument("--threads", type=int, nargs="+", default=[1, 8, 32])
+    p.add_argument("--ops", type=int, default=400, help="operations per thread")
+
+    p = sub.add_parser("planning", help="comprehensive_planning latency against a fake LLM")
+    p.add_argument("--files", type=int, default=4)
+    p.add_argument("--latency", type=float, default=1.0, help="seconds per fake LLM call")
+    p.add_argument("--backend", choices=["inproc", "http"], default="inproc",
+                   help="call the fake LLM directly or through a local OpenAI-compatible server")
+
+    p = sub.add_parser("extract", help="PDF extraction pages/sec and peak RSS")
+    p.add_argument("--pages", type=int, default=500)
+    p.add_argument("--workers", type=int, default=None, help="process pool size (default: CPU count)")
+
+    p = sub.add_parser("search", help="full-text library search latency")
+    p.add_argument("--items", type=int, default=100000, help="items per user")
+    p.add_argument("--users", type=int, default=2)
+
+    p = sub.add_parser("retrieval", help="BM25 retrieval latency for planning prompts")
+    p.add_argument("--chunks", type=int, default=1000000)
+
+    p = sub.add_parser("library", help="Content Library page load and DB size, inline vs compressed bodies")
+    p.add_argument("--items", type=int, default=10000)
+    p.add_argument("--words", type=int, default=500, help="words per item")
+
+    p = sub.add_parser("context", help="concurrent users on shared agents, checking for cross-user bleed")
+    p.add_argument("--threads", type=int, default=32, help="users, one thread each")
+    p.add_argument("--plans", type=int, default=5, help="plans per user")
+    p.add_argument("--latency", type=float, default=0.1, help="seconds per fake LLM call")
+
+    p = sub.add_parser("cache", help="profile and session-pointer reads per click, with and without the read cache")
+    p.add_argument("--users", type=int, default=100)
+    p.add_argument("--clicks", type=int, default=50000)
+    p.add_argument("--write-every", type=int, default=50, help="clicks between profile/session writes (0: none)")
+
+    p = sub.add_parser("writes", help="small-write throughput: immediate, group commit and write-behind")
+    p.add_argument("--threads", type=int, nargs="+", default=[1, 8, 32])
+    p.add_argument("--clicks", type=int, default=200, help="plan clicks per thread, 6 writes each")
+    p.add_argument("--synchronous", choices=["OFF", "NORMAL", "FULL"], default="FULL",
+                   help="SQLite synchronous pragma; FULL syncs every commit")
+
+    p = sub.add_parser("startup", help="module import times (python -X importtime) and spawn-pool start-up")
+    p.add_argument("--workers", type=int, nargs="+", default=[1, 4, 8])
+    p.add_argument("--repeat", type=int, default=3, help="fresh processes per module; the fastest counts")
+
+    sub.add_parser("suite", help="state, extract, planning, library, search, context, cache, writes and "
+                                 "startup at modest sizes")
+
+    args = parser.parse_args()
+    if args.bench == "state":
+        results = bench_state(args.threads, args.ops)
+    elif args.bench == "planning":
+        results = bench_planning(args.files, args.latency, args.backend)
+    elif args.bench == "extract":
+        results = bench_extract(args.pages, args.workers)
+    elif args.bench == "search":
+        results = bench_search(args.items, args.users)
+    elif args.bench == "retrieval":
+        results = bench_retrieval(args.chunks)
+    elif args.bench == "library":
+        results = bench_library(args.items, args.words)
+    elif args.bench == "startup":
+        results = bench_startup(args.workers, args.repeat)
+    elif args.bench == "writes":
+        results = bench_writes(args.threads, args.clicks, args.synchronous)
+    elif args.bench == "cache":
+        results = bench_cache(args.users, args.clicks, args.write_every)
+    elif args.bench == "context":
+        results = bench_context(args.threads, args.plans, args.latency)
+    else:
+        results = bench_suite()
+    if args.json:
+        write_json(args.json, args.bench, results)
+
+
+if __name__ == "__main__":
+    main()
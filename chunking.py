@@ -0,0 +1,39 @@
+CHARS_PER_TOKEN = 4
+
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def chunk_text(content: str, max_tokens: int = 2000, overlap: int = 200) -> list:
+    """Split text on line boundaries into chunks of about max_tokens, each
+    starting with the last `overlap` tokens of the previous one"""
+    return list(iter_chunks([content], max_tokens, overlap))
+
+
+def iter_chunks(pieces, max_tokens: int = 2000, overlap: int = 200):
+    """Streaming chunk_text over an iterable of text pieces (e.g. iter_pages),
+    yielding each chunk as soon as it is full"""
+    max_chars = max_tokens * CHARS_PER_TOKEN
+    overlap_chars = overlap * CHARS_PER_TOKEN
+    current, emitted = "", False
+
+    for piece in pieces:
+        for line in piece.splitlines(keepends=True):
+            # Hard-split lines that are longer than a whole chunk
+            while len(line) > max_chars:
+                line_part, line = line[:max_chars], line[max_chars:]
+                if current:
+                    yield current
+                    current = current[-overlap_chars:] if overlap_chars else ""
+                yield current + line_part
+                emitted = True
+                current = line_part[-overlap_chars:] if overlap_chars else ""
+            if current and len(current) + len(line) > max_chars:
+                yield current
+                emitted = True
+                current = current[-overlap_chars:] if overlap_chars else ""
+            current += line
+
+    if current.strip() or not emitted:
+        yield current
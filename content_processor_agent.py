@@ -1,108 +1,418 @@
+import contextvars
+import multiprocessing
 import os
-import PyPDF2
-import docx
-from base_agent import BaseAgent
+import threading
+import time
+from base_agent import BaseAgent, _run_inline
+from chunking import estimate_tokens, iter_chunks
+from extraction_cache import extraction_cache
+from llm_scheduler import BACKGROUND, LLMError, priority
+from metrics import metrics
+from retrieval_index import retriever
 from SQLiteState import *
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from functools import partial
 from pathlib import Path
 
 
-class ContentProcessorAgent(BaseAgent):
-    def __init__(self):
-        super().__init__("ContentProcessor")
-        self.file_cache = {}
+def iter_pages(file_path: str, progress=None, workers: int = None, parallel_pages: int = 64,
+               pages_per_task: int = None):
+    """Yield a file's text in order: a page (PDF) or paragraph (DOCX) at a time, TXT in one piece.
+
+    PDFs with at least `parallel_pages` pages are extracted across a process
+    pool, by default in about two page ranges per worker. progress(done, total)
+    is called after each page.
+    """
+    ext = Path(file_path).suffix.lower()
+    # The parsers are imported on first use: they are slow to load and most runs never need them
+    if ext == '.pdf':
+        import PyPDF2
+        with open(file_path, 'rb') as f:
+            total = len(PyPDF2.PdfReader(f).pages)
+        pool = None
+        workers = workers or os.cpu_count() or 1
+        if total < parallel_pages or workers == 1:
+            batches = ([text] for text in _iter_pdf_pages(file_path))
+        else:
+            pages_per_task = pages_per_task or max(16, -(-total // (workers * 2)))
+            pool = _process_pool(workers)
+            futures = [pool.submit(_extract_pdf_pages, file_path, start, min(start + pages_per_task, total))
+                       for start in range(0, total, pages_per_task)]
+            batches = (future.result() for future in futures)
+        done = 0
+        try:
+            for batch in batches:
+                for text in batch:
+                    done += 1
+                    if progress:
+                        progress(done, total)
+                    yield text
+        finally:
+            if pool:
+                pool.shutdown(cancel_futures=True)
+    elif ext in ['.docx', '.doc']:
+        import docx
+        paragraphs = docx.Document(file_path).paragraphs
+        for done, p in enumerate(paragraphs, 1):
+            if progress:
+                progress(done, len(paragraphs))
+            yield p.text
+    elif ext in ['.txt', '.md']:
+        with open(file_path, 'r', encoding='utf-8') as f:
+            yield f.read()
+        if progress:
+            progress(1, 1)
+    else:
+        raise ValueError(f"Unsupported file: {ext}")
+
+
+def _process_pool(workers: int) -> ProcessPoolExecutor:
+    """Process pool for extraction. Workers are spawned, not forked: pools are started from
+    threads while others run, and a child forked while one of them held a lock can hang"""
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+
+
+def _iter_pdf_pages(file_path: str):
+    import PyPDF2
+    with open(file_path, 'rb') as f:
+        for page in PyPDF2.PdfReader(f).pages:
+            yield page.extract_text() or ""
+
+
+def _extract_pdf_pages(file_path: str, start: int, stop: int) -> list:
+    """Text of PDF pages [start, stop); runs in pool workers"""
+    import PyPDF2
+    with open(file_path, 'rb') as f:
+        pages = PyPDF2.PdfReader(f).pages
+        return [pages[i].extract_text() or "" for i in range(start, stop)]
+
+
+def _extract_file(file_path: str):
+    """Full text of a file and the seconds extraction took; runs in pool workers"""
+    start = time.perf_counter()
+    text = "\n".join(iter_pages(file_path, workers=1))
+    return text, time.perf_counter() - start
 
-    def read_file(self, file_path: str):
-        """Read and cache file content"""
-        if file_path in self.file_cache:
-            return self.file_cache[file_path]
 
+class ContentProcessorAgent(BaseAgent):
+    chunk_tokens = 2000
+    chunk_overlap = 200
+
+    def __init__(self, client=None):
+        super().__init__("ContentProcessor", client=client)
+        # (content hash, style) -> Future of analyses that are still running
+        self._analyses = {}
+        self._analyses_lock = threading.Lock()
+        self._analysis_pool = None
+
+    def read_file(self, file_path: str, progress=None):
+        """Read file content, cached by the hash of the file bytes"""
+        return self._read(file_path, progress)[1]
+
+    def read_files(self, file_paths: list, workers: int = None, progress=None) -> list:
+        """Read many files in one pass.
+
+        Files with identical bytes are read once, and those not already in the
+        extraction cache are extracted in parallel across a process pool.
+        Returns a dict per path with its digest, content, extraction seconds,
+        whether it came from the cache, the earlier path it duplicates, and
+        any error. progress(done, total) is called as each file finishes.
+        """
+        entries, first, pending = [], {}, []
+        for path in file_paths:
+            entry = {"path": path, "digest": None, "content": None, "seconds": 0.0,
+                     "cached": False, "duplicate_of": None, "error": None}
+            entries.append(entry)
+            try:
+                entry["digest"] = extraction_cache.file_hash(path)
+            except OSError as e:
+                entry["error"] = f"Error reading file: {e}"
+                continue
+            if entry["digest"] in first:
+                entry["duplicate_of"] = first[entry["digest"]]["path"]
+                continue
+            first[entry["digest"]] = entry
+            entry["content"] = extraction_cache.get(entry["digest"])
+            if entry["content"] is not None:
+                entry["cached"] = True
+            else:
+                pending.append(entry)
+
+        done = len(entries) - len(pending)
+        if progress:
+            progress(done, len(entries))
+        if pending:
+            workers = min(workers or os.cpu_count() or 1, len(pending))
+            # A single worker would only add the pool's start-up cost
+            pool = _process_pool(workers) if workers > 1 else None
+            try:
+                if pool:
+                    futures = {pool.submit(_extract_file, entry["path"]): entry for entry in pending}
+                    finished = ((future, futures[future]) for future in as_completed(futures))
+                else:
+                    finished = ((_run_inline(partial(_extract_file, entry["path"])), entry) for entry in pending)
+                for future, entry in finished:
+                    try:
+                        entry["content"], entry["seconds"] = future.result()
+                        extraction_cache.put(entry["digest"], entry["content"])
+                        # Timed in the worker process, so recorded here
+                        metrics.record("file.extract", entry["seconds"], chars=len(entry["content"]))
+                    except Exception as e:
+                        entry["error"] = f"Error reading file: {e}"
+                    done += 1
+                    if progress:
+                        progress(done, len(entries))
+            finally:
+                if pool:
+                    pool.shutdown(cancel_futures=True)
+
+        for entry in entries:
+            if entry["duplicate_of"]:
+                entry["content"] = first[entry["digest"]]["content"]
+        return entries
+
+    def _read(self, file_path: str, progress=None):
+        """(content hash, content) of a file; the hash is None if it couldn't be read"""
         ext = Path(file_path).suffix.lower()
+        if ext not in ['.pdf', '.docx', '.doc', '.txt', '.md']:
+            return None, f"Unsupported file: {ext}"
         try:
-            if ext == '.pdf':
-                with open(file_path, 'rb') as f:
-                    content = "\n".join([page.extract_text() for page in PyPDF2.PdfReader(f).pages])
-            elif ext in ['.docx', '.doc']:
-                content = "\n".join([p.text for p in docx.Document(file_path).paragraphs])
-            elif ext in ['.txt', '.md']:
-                with open(file_path, 'r', encoding='utf-8') as f:
-                    content = f.read()
-            else:
-                return f"Unsupported file: {ext}"
-
-            self.file_cache[file_path] = content
-
-            # Auto-analyze and save
-            if self.current_user_id:
-                analysis = self.analyze_for_planning(content, file_path)
-                save_content(self.current_user_id, Path(file_path).name, "file_analysis", analysis)
-
-            return content
+            with metrics.span("file.read", cached=0) as span:
+                digest = extraction_cache.file_hash(file_path)
+                content = extraction_cache.get(digest)
+                if content is not None:
+                    span["cached"] = 1
+                    return digest, content
+
+                content = "\n".join(iter_pages(file_path, progress))
+                extraction_cache.put(digest, content)
+                span["chars"] = len(content)
+                return digest, content
         except Exception as e:
-            return f"Error reading file: {str(e)}"
-
-    def analyze_for_planning(self, content: str, filename: str):
+            return None, f"Error reading file: {str(e)}"
+
+    def analyze_file(self, file_path: str, original_filename: str = None, wait: bool = True):
+        """Planning analysis of a file, computed at most once per content hash and
+        learning style. With wait=False the analysis runs in the background and a
+        Future is returned; its `timing` dict gets the perf_counter() start and end
+        of the analysis itself, not counting time queued for the pool."""
+        digest, content = self._read(file_path)
+        if digest is None:
+            future = Future()
+            future.set_result(content)
+        else:
+            future = self._schedule_analysis(digest, content, original_filename or Path(file_path).name)
+        return future.result() if wait else future
+
+    def _schedule_analysis(self, digest: str, content: str, filename: str):
+        user_id = self.current_user_id
+        user = get_user(user_id) if user_id else {}
+        style = user.get('style', 'visual')
+        key = (digest, style)
+
+        submitted = None
+        with self._analyses_lock:
+            shared = self._analyses.get(key)
+            if shared is None:
+                # Without use_cache every analysis is computed afresh, as LLM calls are
+                stored = extraction_cache.get_analysis(digest, style) if self.use_cache else None
+                if stored is not None:
+                    shared = Future()
+                    now = time.perf_counter()
+                    shared.timing = {"start": now, "end": now}
+                    shared.set_result(stored)
+                else:
+                    if self._analysis_pool is None:
+                        self._analysis_pool = ThreadPoolExecutor(max_workers=self.max_concurrency,
+                                                                 thread_name_prefix="analysis")
+                    # Run in a copy of the caller's context so the analysis is made for the same user
+                    timing = {}
+                    shared = self._analysis_pool.submit(contextvars.copy_context().run, self._run_analysis,
+                                                        digest, content, filename, style, timing)
+                    shared.timing = timing
+                    self._analyses[key] = submitted = shared
+        # Outside the lock: an analysis that already finished runs the callback right here
+        if submitted is not None:
+            submitted.add_done_callback(lambda future: self._forget_analysis(key, future))
+        return self._for_user(shared, digest, content, filename, user_id)
+
+    def _run_analysis(self, digest, content, filename, style, timing):
+        timing["start"] = time.perf_counter()
+        try:
+            # Analyses are prefetched, so let interactive requests go first
+            with priority(BACKGROUND):
+                analysis = self.analyze_for_planning(content, filename, style)
+        finally:
+            timing["end"] = time.perf_counter()
+        if self.use_cache:
+            extraction_cache.put_analysis(digest, style, analysis)
+        return analysis
+
+    def _for_user(self, shared, digest, content, filename, user_id):
+        """A Future of the shared analysis that resolves once it is filed for user_id"""
+        if not user_id:
+            return shared
+        future = Future()
+        future.timing = shared.timing
+
+        def done(shared):
+            try:
+                analysis = shared.result()
+                self._file_analysis(user_id, digest, filename, content, analysis)
+            except Exception as e:
+                future.set_exception(e)
+            else:
+                future.set_result(analysis)
+
+        shared.add_done_callback(done)
+        return future
+
+    def _file_analysis(self, user_id, digest, filename, content, analysis):
+        """Index the file and save its analysis to the user's library, once per (user, file)"""
+        if retriever.add_document(user_id, f"file:{digest}", filename, "file", content):
+            self.save_result(filename, "file_analysis", analysis, user_id)
+
+    def _forget_analysis(self, key, future):
+        with self._analyses_lock:
+            if self._analyses.get(key) is future:
+                del self._analyses[key]
+
+    def map_reduce(self, content: str, map_prompt, reduce_prompt, max_tokens: int = 800, on_token=None):
+        """Run map_prompt over every chunk of content concurrently, then merge the
+        partial results with reduce_prompt, a group at a time, until one is left.
+
+        Both prompts are callables taking the text to embed. Identical chunk and
+        merge prompts are answered from the LLM cache, so re-runs are cheap.
+        Only the final call is streamed to on_token.
+        """
+        chunks = list(iter_chunks([content], self.chunk_tokens, self.chunk_overlap))
+        if len(chunks) == 1:
+            return self.call_ai(map_prompt(chunks[0]), max_tokens, on_token)
+
+        partials = self.run_parallel([partial(self.call_ai, map_prompt(chunk), max_tokens) for chunk in chunks])
+        # A result missing chunks must not reach the library as if it were complete. Chunks that
+        # did succeed are in the LLM cache, so trying again only repeats the failed ones.
+        failed = [r for r in partials if isinstance(r, Exception)]
+        if failed:
+            raise LLMError(f"{len(failed)} of {len(chunks)} chunks failed: {failed[0]}")
+
+        while True:
+            groups, group, size = [], [], 0
+            for result in partials:
+                tokens = estimate_tokens(result)
+                if len(group) >= 2 and size + tokens > self.chunk_tokens:
+                    groups.append(group)
+                    group, size = [], 0
+                group.append(result)
+                size += tokens
+            groups.append(group)
+
+            if len(groups) == 1:
+                return self.call_ai(reduce_prompt("\n\n---\n\n".join(group)), max_tokens, on_token)
+
+            merged = iter(self.run_parallel([
+                partial(self.call_ai, reduce_prompt("\n\n---\n\n".join(group)), max_tokens)
+                for group in groups if len(group) > 1]))
+            partials = [next(merged) if len(group) > 1 else group[0] for group in groups]
+            for result in partials:
+                if isinstance(result, Exception):
+                    raise result
+
+    def analyze_for_planning(self, content: str, filename: str, style: str = None):
         """content analysis"""
-        user = state.get(f"user:{self.current_user_id}", {}) if self.current_user_id else {}
+        if style is None:
+            user = get_user(self.current_user_id) if self.current_user_id else {}
+            style = user.get('style', 'visual')
 
-        prompt = f"""Analyze for study planning:
+        return self.map_reduce(
+            content,
+            lambda text: f"""Analyze for study planning:
 File: {Path(filename).name}
-Style: {user.get('style', 'visual')}
-Content: {content[:1500]}
+Style: {style}
+Content: {text}
+
+Provide: subject, key concepts, difficulty, study time, focus areas.""",
+            lambda text: f"""Combine these analyses of parts of one file into a single analysis for study planning:
+File: {Path(filename).name}
+Style: {style}
 
-Provide: subject, key concepts, difficulty, study time, focus areas."""
+{text}
 
-        return self.call_ai(prompt, 400)
+Provide: subject, key concepts, difficulty, study time, focus areas.""",
+            400)
 
     def create_summary(self, file_path: str, summary_type: str = "detailed", length: str = "medium",
-                       original_filename: str = None):
+                       original_filename: str = None, on_token=None):
         """Create summary"""
-        content = self.read_file(file_path)
-        if content.startswith("Error"):
+        digest, content = self._read(file_path)
+        if digest is None:
             return content
+        # Warm the shared file analysis off the critical path of this request
+        self._schedule_analysis(digest, content, original_filename or Path(file_path).name)
 
-        user = state.get(f"user:{self.current_user_id}", {}) if self.current_user_id else {}
+        user = get_user(self.current_user_id) if self.current_user_id else {}
 
-        prompt = f"Create a {length} summary for a {user.get('style', 'visual')} learner:\n{content[:3000]}"
-        result = self.call_ai(prompt, 800)
+        style = user.get('style', 'visual')
+        result = self.map_reduce(
+            content,
+            lambda text: f"Create a {length} summary for a {style} learner:\n{text}",
+            lambda text: f"Combine these summaries of consecutive parts of one document into a single "
+                         f"{length} summary for a {style} learner:\n{text}",
+            on_token=on_token)
 
         if self.current_user_id:
             filename = original_filename or Path(file_path).name
-            save_content(self.current_user_id, filename, "summary", result)
+            self.save_result(filename, "summary", result)
 
         return result
 
-    def create_notes(self, file_path: str, note_style: str = "detailed", original_filename: str = None):
+    def create_notes(self, file_path: str, note_style: str = "detailed", original_filename: str = None,
+                     on_token=None):
         """Create notes"""
-        content = self.read_file(file_path)
-        if content.startswith("Error"):
+        digest, content = self._read(file_path)
+        if digest is None:
             return content
+        # Warm the shared file analysis off the critical path of this request
+        self._schedule_analysis(digest, content, original_filename or Path(file_path).name)
 
-        user = state.get(f"user:{self.current_user_id}", {}) if self.current_user_id else {}
+        user = get_user(self.current_user_id) if self.current_user_id else {}
 
-        prompt = f"Create study notes for a {user.get('style', 'visual')} learner:\n{content[:3000]}\n\nInclude main topics, key facts, and review questions."
-        result = self.call_ai(prompt, 800)
+        style = user.get('style', 'visual')
+        result = self.map_reduce(
+            content,
+            lambda text: f"Create study notes for a {style} learner:\n{text}\n\nInclude main topics, key facts, and review questions.",
+            lambda text: f"Merge these study notes on consecutive parts of one document into a single set of notes "
+                         f"for a {style} learner, removing duplicates:\n{text}\n\nInclude main topics, key facts, and review questions.",
+            on_token=on_token)
 
         if self.current_user_id:
             filename = original_filename or Path(file_path).name
-            save_content(self.current_user_id, filename, "notes", result)
+            self.save_result(filename, "notes", result)
 
         return result
 
     def create_questions(self, file_path: str, question_type: str = "mixed", difficulty: str = "medium",
-                         original_filename: str = None):
+                         original_filename: str = None, on_token=None):
         """Generate questions"""
-        content = self.read_file(file_path)
-        if content.startswith("Error"):
+        digest, content = self._read(file_path)
+        if digest is None:
             return content
+        # Warm the shared file analysis off the critical path of this request
+        self._schedule_analysis(digest, content, original_filename or Path(file_path).name)
 
-        user = state.get(f"user:{self.current_user_id}", {}) if self.current_user_id else {}
+        user = get_user(self.current_user_id) if self.current_user_id else {}
 
-        prompt = f"Generate {difficulty} questions for a {user.get('style', 'visual')} learner:\n{content[:3000]}\n\nInclude recall, comprehension, and application questions with answers."
-        result = self.call_ai(prompt, 800)
+        style = user.get('style', 'visual')
+        result = self.map_reduce(
+            content,
+            lambda text: f"Generate {difficulty} questions for a {style} learner:\n{text}\n\nInclude recall, comprehension, and application questions with answers.",
+            lambda text: f"Merge these question sets on parts of one document into a single balanced set of {difficulty} "
+                         f"questions for a {style} learner, dropping near-duplicates:\n{text}\n\nInclude recall, comprehension, and application questions with answers.",
+            on_token=on_token)
 
         if self.current_user_id:
             filename = original_filename or Path(file_path).name
-            save_content(self.current_user_id, filename, "questions", result)
+            self.save_result(filename, "questions", result)
 
         return result
 
@@ -111,20 +421,29 @@ Provide: subject, key concepts, difficulty, study time, focus areas."""
         if not self.current_user_id:
             return "No user context available. Please set user first."
 
-        user_content = state.get_list(f"user_content:{self.current_user_id}", 10)
-        if not user_content:
+        latest = get_user_content(self.current_user_id, 1)
+        if not latest:
             return "No files processed yet. Please process a file first."
 
         # Get content for latest file
-        latest_file = user_content[0]['filename']
+        latest_file = latest[0]['filename']
         file_content = [f"{item['type'].upper()}: {item['content']}"
-                        for item in user_content if item['filename'] == latest_file]
+                        for item in get_user_content(self.current_user_id, 10, filename=latest_file,
+                                                     with_content=True)]
 
         if not file_content:
             return "No processed content found for this file."
 
-        user = state.get(f"user:{self.current_user_id}", {})
-        combined_content = "\n\n".join(file_content)
+        user = get_user(self.current_user_id)
+
+        # Pull the passages most related to this file from every upload and artifact,
+        # within the same ~2000 characters the prompt used to take from the latest file alone
+        query = f"{Path(latest_file).stem} " + " ".join(item[:500] for item in file_content)
+        passages = retriever.search(self.current_user_id, query, token_budget=500)
+        if passages:
+            combined_content = "\n\n".join(f"{p['kind'].upper()} ({p['source']}): {p['text']}" for p in passages)
+        else:
+            combined_content = "\n\n".join(file_content)
 
         prompt = f"""Create study plan:
 File: {latest_file}
@@ -140,6 +459,6 @@ Create a plan that uses the content above, breaks down {hours} hours until {dead
         result = self.call_ai(prompt, 1000)
 
         if self.current_user_id:
-            save_content(self.current_user_id, f"Study Plan - {latest_file}", "study_plan", result)
+            self.save_result(f"Study Plan - {latest_file}", "study_plan", result)
 
         return result
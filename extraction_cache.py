@@ -0,0 +1,125 @@
+import hashlib
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+from SQLiteState import state
+
+
+class ExtractionCache:
+    """Extracted file text keyed by the SHA-256 of the file bytes.
+
+    A small in-memory LRU sits in front of a zlib-compressed SQLite table
+    that is evicted least-recently-used first once it exceeds max_bytes.
+    """
+
+    def __init__(self, db, memory_items=32, max_bytes=256 * 1024 * 1024):
+        self.db = db
+        self.memory_items = memory_items
+        self.max_bytes = max_bytes
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self.db.on_ready(self._create_tables)
+
+    def _create_tables(self):
+        # Drop texts read from a database state.use() switched away from
+        self._memory = OrderedDict()
+        with self.db.transaction() as conn:
+            conn.execute('''CREATE TABLE IF NOT EXISTS extractions (
+                hash TEXT PRIMARY KEY,
+                content BLOB,
+                size INTEGER,
+                last_used REAL
+            )''')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_extractions_last_used ON extractions (last_used)')
+            conn.execute('''CREATE TABLE IF NOT EXISTS file_analyses (
+                hash TEXT,
+                style TEXT,
+                analysis TEXT,
+                created_at REAL,
+                PRIMARY KEY (hash, style)
+            )''')
+
+    @staticmethod
+    def file_hash(file_path: str) -> str:
+        digest = hashlib.sha256()
+        with open(file_path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def get(self, digest: str):
+        """Cached text for a content hash, or None"""
+        with self._lock:
+            if digest in self._memory:
+                self._memory.move_to_end(digest)
+                return self._memory[digest]
+
+        try:
+            with self.db.connection() as conn:
+                row = conn.execute('SELECT content FROM extractions WHERE hash = ?', (digest,)).fetchone()
+            if not row:
+                return None
+            with self.db.transaction() as conn:
+                conn.execute('UPDATE extractions SET last_used = ? WHERE hash = ?', (time.time(), digest))
+            text = zlib.decompress(row['content']).decode('utf-8')
+        except Exception as e:
+            print(f"Error reading extraction cache: {e}")
+            return None
+
+        self._remember(digest, text)
+        return text
+
+    def put(self, digest: str, text: str):
+        self._remember(digest, text)
+        blob = zlib.compress(text.encode('utf-8'))
+        try:
+            with self.db.transaction() as conn:
+                conn.execute('INSERT OR REPLACE INTO extractions VALUES (?, ?, ?, ?)',
+                             (digest, blob, len(blob), time.time()))
+                self._evict(conn)
+        except Exception as e:
+            print(f"Error writing extraction cache: {e}")
+
+    def get_analysis(self, digest: str, style: str):
+        """Stored planning analysis for a content hash and learning style, or None"""
+        try:
+            with self.db.connection() as conn:
+                row = conn.execute('SELECT analysis FROM file_analyses WHERE hash = ? AND style = ?',
+                                   (digest, style)).fetchone()
+                return row['analysis'] if row else None
+        except Exception as e:
+            print(f"Error reading file analysis: {e}")
+            return None
+
+    def put_analysis(self, digest: str, style: str, analysis: str):
+        try:
+            with self.db.transaction() as conn:
+                conn.execute('INSERT OR REPLACE INTO file_analyses VALUES (?, ?, ?, ?)',
+                             (digest, style, analysis, time.time()))
+        except Exception as e:
+            print(f"Error writing file analysis: {e}")
+
+    def _remember(self, digest, text):
+        with self._lock:
+            self._memory[digest] = text
+            self._memory.move_to_end(digest)
+            while len(self._memory) > self.memory_items:
+                self._memory.popitem(last=False)
+
+    def _evict(self, conn):
+        """Drop least recently used extractions until the table fits in max_bytes"""
+        total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM extractions').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        stale = []
+        for row in conn.execute('SELECT hash, size FROM extractions ORDER BY last_used'):
+            if total <= self.max_bytes:
+                break
+            stale.append((row['hash'],))
+            total -= row['size']
+        conn.executemany('DELETE FROM extractions WHERE hash = ?', stale)
+
+
+extraction_cache = ExtractionCache(state)
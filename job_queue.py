@@ -0,0 +1,295 @@
+import contextvars
+import hashlib
+import json
+import threading
+import time
+import uuid
+from datetime import datetime
+from pathlib import Path
+
+from content_processor_agent import ContentProcessorAgent
+from ingest import format_report, ingest
+from study_planner_agent import StudyPlannerAgent
+from SQLiteState import *
+
+# Uploaded files are kept here, named by content hash, until no queued, running or failed job
+# needs them; files stored in the last UPLOAD_GRACE seconds are kept for jobs about to be submitted
+UPLOAD_DIR = Path("uploads")
+UPLOAD_GRACE = 600
+
+
+class JobQueue:
+    """Persistent queue of long-running agent tasks.
+
+    Jobs are rows in SQLite, so they outlive Streamlit reruns and app
+    restarts: jobs left `running` by a previous process are queued again
+    on start, and failed jobs can be retried. A small pool of worker
+    threads runs the handler registered for each job's kind; handlers
+    report progress and partial output, which the UI polls.
+    """
+
+    def __init__(self, db, workers=2, partial_interval=0.5, sweep_interval=60):
+        self.db = db
+        self.workers = workers
+        self.partial_interval = partial_interval
+        self.sweep_interval = sweep_interval
+        self._swept = 0.0
+        self.handlers = {}
+        self._wakeup = threading.Condition()
+        self._threads = []
+        self._start_lock = threading.Lock()
+        self.db.on_ready(self._create_tables)
+
+    def _create_tables(self):
+        with self.db.transaction() as conn:
+            conn.execute('''CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                user_id TEXT,
+                kind TEXT,
+                params TEXT,
+                status TEXT DEFAULT 'queued',
+                progress REAL DEFAULT 0,
+                partial TEXT DEFAULT '',
+                result TEXT,
+                error TEXT,
+                attempts INTEGER DEFAULT 0,
+                created_at TEXT,
+                updated_at TEXT
+            )''')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_jobs_user_created ON jobs (user_id, created_at)')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_jobs_status_created ON jobs (status, created_at)')
+
+    def register(self, kind, handler):
+        """handler(job, update) runs a job and returns its result text;
+        update(progress=None, partial=None) records how far it has got"""
+        self.handlers[kind] = handler
+
+    def submit(self, user_id, kind, **params):
+        job_id = str(uuid.uuid4())
+        now = datetime.now().isoformat()
+        with self.db.transaction() as conn:
+            conn.execute('''INSERT INTO jobs (id, user_id, kind, params, created_at, updated_at)
+                            VALUES (?, ?, ?, ?, ?, ?)''', (job_id, user_id, kind, json.dumps(params), now, now))
+        self.start()
+        with self._wakeup:
+            self._wakeup.notify()
+        return job_id
+
+    def retry(self, job_id):
+        """Queue a failed job again; chunk calls it already made are answered from the LLM cache"""
+        with self.db.transaction() as conn:
+            conn.execute('''UPDATE jobs SET status = 'queued', progress = 0, partial = '', error = NULL,
+                                            updated_at = ?
+                            WHERE id = ? AND status = ?''', (datetime.now().isoformat(), job_id, "failed"))
+        with self._wakeup:
+            self._wakeup.notify()
+
+    def get(self, job_id):
+        try:
+            with self.db.connection() as conn:
+                row = conn.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+                return _job(row) if row else None
+        except Exception as e:
+            print(f"Error getting job {job_id}: {e}")
+            return None
+
+    def list(self, user_id, limit=10):
+        """A user's most recent jobs, newest first"""
+        try:
+            with self.db.connection() as conn:
+                rows = conn.execute('''SELECT * FROM jobs WHERE user_id = ?
+                                    ORDER BY created_at DESC LIMIT ?''', (user_id, limit)).fetchall()
+                return [_job(row) for row in rows]
+        except Exception as e:
+            print(f"Error listing jobs for {user_id}: {e}")
+            return []
+
+    def start(self):
+        """Start the workers, first re-queueing jobs a previous process didn't finish"""
+        with self._start_lock:
+            if self._threads:
+                return
+            with self.db.transaction() as conn:
+                resumed = conn.execute("UPDATE jobs SET status = 'queued' WHERE status = 'running'").rowcount
+            if resumed:
+                print(f"Resuming {resumed} interrupted jobs")
+            self.sweep_uploads()
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._work, name=f"job-worker-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def _claim(self):
+        """Mark the oldest queued job running and return it, or None"""
+        with self.db.transaction() as conn:
+            row = conn.execute('''SELECT * FROM jobs WHERE status = 'queued'
+                                  ORDER BY created_at LIMIT 1''').fetchone()
+            if not row:
+                return None
+            conn.execute('''UPDATE jobs SET status = 'running', attempts = attempts + 1, updated_at = ?
+                            WHERE id = ?''', (datetime.now().isoformat(), row['id']))
+            return _job(row)
+
+    def _work(self):
+        while True:
+            try:
+                job = self._claim()
+            except Exception as e:
+                print(f"Error claiming job: {e}")
+                job = None
+            if job is None:
+                with self._wakeup:
+                    self._wakeup.wait(timeout=5)
+            else:
+                self._run(job)
+            if time.monotonic() - self._swept >= self.sweep_interval:
+                self.sweep_uploads()
+
+    def sweep_uploads(self):
+        """Delete uploads no queued, running or failed job refers to, once past UPLOAD_GRACE"""
+        self._swept = time.monotonic()
+        if not UPLOAD_DIR.exists():
+            return
+        try:
+            with self.db.connection() as conn:
+                rows = conn.execute("SELECT params FROM jobs WHERE status IN ('queued', 'running', 'failed')")
+                needed = set()
+                for row in rows:
+                    params = json.loads(row['params'] or "{}")
+                    needed.update(params.get("paths") or [params.get("path")])
+            needed = {Path(path).name for path in needed if path}
+            cutoff = time.time() - UPLOAD_GRACE
+            for path in UPLOAD_DIR.iterdir():
+                if path.name not in needed and path.stat().st_mtime < cutoff:
+                    path.unlink(missing_ok=True)
+        except Exception as e:
+            print(f"Error sweeping uploads: {e}")
+
+    def _run(self, job):
+        handler = self.handlers.get(job["kind"])
+        parts, last_write = [], [0.0]
+
+        def update(progress=None, partial=None):
+            if partial:
+                parts.append(partial)
+            now = time.monotonic()
+            # Streamed tokens arrive far faster than the UI polls; write at most every partial_interval
+            if progress is None and now - last_write[0] < self.partial_interval:
+                return
+            last_write[0] = now
+            self._update(job["id"], "running", progress=progress, partial="".join(parts))
+
+        try:
+            if handler is None:
+                raise ValueError(f"No handler for job kind {job['kind']!r}")
+            # A fresh context per job, so the user a handler sets doesn't outlive the job
+            result = contextvars.Context().run(handler, job, update)
+            self._update(job["id"], "done", progress=1.0, partial="".join(parts), result=result)
+        except Exception as e:
+            print(f"Job {job['id']} ({job['kind']}) failed: {e}")
+            self._update(job["id"], "failed", partial="".join(parts), error=str(e))
+
+    def _update(self, job_id, status, progress=None, partial=None, result=None, error=None):
+        try:
+            with self.db.transaction() as conn:
+                conn.execute('''UPDATE jobs SET status = ?, progress = COALESCE(?, progress),
+                                    partial = COALESCE(?, partial), result = COALESCE(?, result),
+                                    error = ?, updated_at = ?
+                                WHERE id = ?''',
+                             (status, progress, partial, result, error, datetime.now().isoformat(), job_id))
+        except Exception as e:
+            print(f"Error updating job {job_id}: {e}")
+
+
+def _job(row):
+    job = dict(row)
+    job["params"] = json.loads(job["params"] or "{}")
+    return job
+
+
+def store_upload(name, data):
+    """Save uploaded bytes under their content hash and return the path; the same
+    file uploaded again, or seen on a rerun, is not written twice"""
+    UPLOAD_DIR.mkdir(exist_ok=True)
+    path = UPLOAD_DIR / f"{hashlib.sha256(data).hexdigest()}{Path(name).suffix.lower()}"
+    if path.exists():
+        # Restarts the grace period, so the sweep leaves it for the job about to be submitted
+        path.touch()
+    else:
+        tmp = path.with_suffix(path.suffix + ".part")
+        tmp.write_bytes(data)
+        tmp.replace(path)
+    return str(path)
+
+
+# Shared by all workers: the user each job runs for is held in its own context, not on the agents
+_agents = None
+_agents_lock = threading.Lock()
+
+
+def _worker_agents():
+    global _agents
+    with _agents_lock:
+        if _agents is None:
+            processor, planner = ContentProcessorAgent(), StudyPlannerAgent()
+            planner.register_content_processor(processor)
+            _agents = processor, planner
+        return _agents
+
+
+def _process_file(job, update):
+    """summary / notes / questions for an uploaded file"""
+    processor, _ = _worker_agents()
+    params = job["params"]
+    session_id = start_session(job["user_id"], "Processing")
+    processor.set_user(job["user_id"], session_id)
+    try:
+        # Extraction is the first 30%; after that progress is the streamed output
+        processor.read_file(params["path"], progress=lambda done, total: update(0.3 * done / total))
+        update(0.3)
+        on_token = lambda delta: update(partial=delta)
+        if job["kind"] == "summary":
+            return processor.create_summary(params["path"], "detailed", "medium", params["filename"],
+                                            on_token=on_token)
+        if job["kind"] == "notes":
+            return processor.create_notes(params["path"], "detailed", params["filename"], on_token=on_token)
+        return processor.create_questions(params["path"], "mixed", "medium", params["filename"],
+                                          on_token=on_token)
+    finally:
+        end_session(session_id)
+
+
+def _file_plan(job, update):
+    """Comprehensive plan built around one or more uploaded files"""
+    _, planner = _worker_agents()
+    params = job["params"]
+    session_id = start_session(job["user_id"], "File Planning")
+    planner.set_user(job["user_id"], session_id)
+    try:
+        update(0.1)
+        return planner.comprehensive_planning("File Study", params["hours"], params["deadline"], "File Content",
+                                              "Master content", params.get("paths") or [params["path"]],
+                                              on_token=lambda delta: update(partial=delta),
+                                              filenames=params.get("filenames"))
+    finally:
+        end_session(session_id)
+
+
+def _ingest(job, update):
+    """Extract and analyse a batch of uploads into the library"""
+    processor, _ = _worker_agents()
+    params = job["params"]
+    session_id = start_session(job["user_id"], "Ingestion")
+    try:
+        report = ingest(params["paths"], job["user_id"], processor, params["filenames"],
+                        progress=lambda done, total: update(done / total))
+        return format_report(report)
+    finally:
+        end_session(session_id)
+
+
+jobs = JobQueue(state)
+for _kind in ("summary", "notes", "questions"):
+    jobs.register(_kind, _process_file)
+jobs.register("file_plan", _file_plan)
+jobs.register("ingest", _ingest)
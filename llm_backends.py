@@ -0,0 +1,258 @@
+"""LLM backends for the agents.
+
+Every backend looks like the part of openai.OpenAI the agents use:
+`client.chat.completions.create(...)`, returning a response or, with
+stream=True, an iterator of chunks. `create_client` picks one from the
+environment:
+
+    LLM_BACKEND=openrouter   OpenRouter with OPENROUTER_API_KEY (default)
+    LLM_BACKEND=fake         FakeLLM in-process, tuned with FAKE_LLM_* variables
+    LLM_BASE_URL=...         any OpenAI-compatible server, e.g. `python llm_backends.py serve`
+"""
+import argparse
+import functools
+import hashlib
+import json
+import math
+import os
+import random
+import threading
+import time
+from types import SimpleNamespace
+
+OPENROUTER_URL = "https://openrouter.ai/api/v1"
+
+# Deterministic filler for fake responses
+_WORDS = ("study review concept chapter example practice summary key idea method topic question answer "
+          "definition theory evidence plan session goal focus recall memory note test reading").split()
+
+
+@functools.cache
+def load_env():
+    """Read .env into the environment, once per process"""
+    from dotenv import load_dotenv
+    load_dotenv()
+
+
+def create_client(backend: str = None):
+    """LLM client for `backend` (default: $LLM_BACKEND), or None if it can't be configured"""
+    load_env()
+    backend = backend or os.getenv("LLM_BACKEND", "openrouter")
+    if backend == "fake":
+        return FakeLLM.from_env()
+    # Only the real backends need the openai package, which takes a while to import
+    import openai
+    base_url = os.getenv("LLM_BASE_URL")
+    api_key = os.getenv("OPENROUTER_API_KEY")
+    # Retries are the scheduler's job: SDK retries would bypass its rate limit and Retry-After pause
+    if base_url:
+        return openai.OpenAI(api_key=api_key or "local", base_url=base_url, max_retries=0)
+    if not api_key:
+        return None
+    return openai.OpenAI(api_key=api_key, base_url=OPENROUTER_URL, max_retries=0)
+
+
+class FakeAPIError(Exception):
+    """Injected failure carrying an HTTP status, like openai.APIStatusError"""
+
+    def __init__(self, status_code: int, retry_after: float = None):
+        super().__init__(f"Fake LLM error {status_code}")
+        self.status_code = status_code
+        headers = {"retry-after": str(retry_after)} if retry_after is not None else {}
+        self.response = SimpleNamespace(headers=headers)
+
+
+class APIConnectionError(Exception):
+    """Injected connection failure; named like openai's so the scheduler retries it"""
+
+
+class FakeLLM:
+    """Offline stand-in for the chat completions API.
+
+    Responses are derived from a hash of the prompt, so the same request
+    always gets the same answer. Each call waits for a time to first
+    token drawn from `latency_dist` ("fixed", "uniform" or "lognormal"
+    around `latency` seconds), then produces tokens at `tokens_per_second`.
+    A fraction `error_rate` of calls fail with one of `errors`: an HTTP
+    status code (429 carries a Retry-After of `retry_after` seconds) or
+    "connection".
+    """
+
+    def __init__(self, latency: float = 0.5, latency_dist: str = "fixed", tokens_per_second: float = 0,
+                 response_tokens: int = 200, error_rate: float = 0.0, errors=(500,), retry_after: float = 1.0,
+                 seed: int = 0):
+        self.latency = latency
+        self.latency_dist = latency_dist
+        self.tokens_per_second = tokens_per_second
+        self.response_tokens = response_tokens
+        self.error_rate = error_rate
+        self.errors = tuple(errors)
+        self.retry_after = retry_after
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.stats = {"calls": 0, "errors": 0, "tokens": 0}
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    @classmethod
+    def from_env(cls):
+        errors = os.getenv("FAKE_LLM_ERRORS", "500")
+        return cls(latency=float(os.getenv("FAKE_LLM_LATENCY", "0.5")),
+                   latency_dist=os.getenv("FAKE_LLM_LATENCY_DIST", "fixed"),
+                   tokens_per_second=float(os.getenv("FAKE_LLM_TOKENS_PER_SECOND", "0")),
+                   response_tokens=int(os.getenv("FAKE_LLM_RESPONSE_TOKENS", "200")),
+                   error_rate=float(os.getenv("FAKE_LLM_ERROR_RATE", "0")),
+                   errors=[e if e == "connection" else int(e) for e in errors.split(",")])
+
+    def create(self, model, messages, max_tokens=800, temperature=0.7, stream=False, stream_options=None, **kwargs):
+        prompt = messages[-1]["content"]
+        with self._lock:
+            self.stats["calls"] += 1
+            delay = self._sample_latency()
+            error = self._random.choice(self.errors) if self._random.random() < self.error_rate else None
+            if error is not None:
+                self.stats["errors"] += 1
+        time.sleep(delay)
+        if error == "connection":
+            raise APIConnectionError("Fake LLM connection error")
+        if error is not None:
+            raise FakeAPIError(error, self.retry_after if error == 429 else None)
+
+        words = self._response(model, prompt, min(max_tokens, self.response_tokens))
+        usage = SimpleNamespace(prompt_tokens=len(prompt) // 4, completion_tokens=len(words),
+                                total_tokens=len(prompt) // 4 + len(words))
+        with self._lock:
+            self.stats["tokens"] += usage.total_tokens
+        if stream:
+            return self._stream(words, usage, bool(stream_options and stream_options.get("include_usage")))
+        self._generate(len(words))
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=" ".join(words)))],
+                               usage=usage)
+
+    def _sample_latency(self):
+        if self.latency_dist == "uniform":
+            return self._random.uniform(0, 2 * self.latency)
+        if self.latency_dist == "lognormal":
+            # Median `latency`, with the long tail real APIs have
+            return self.latency * math.exp(self._random.gauss(0, 0.5))
+        return self.latency
+
+    def _generate(self, tokens):
+        if self.tokens_per_second:
+            time.sleep(tokens / self.tokens_per_second)
+
+    @staticmethod
+    def _response(model, prompt, tokens):
+        seed = int.from_bytes(hashlib.sha256(f"{model}\0{prompt}".encode()).digest()[:8], "big")
+        rng = random.Random(seed)
+        return [rng.choice(_WORDS) for _ in range(tokens)]
+
+    def _stream(self, words, usage, include_usage):
+        for i, word in enumerate(words):
+            self._generate(1)
+            delta = SimpleNamespace(content=word if i == 0 else " " + word)
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=delta)], usage=None)
+        if include_usage:
+            yield SimpleNamespace(choices=[], usage=usage)
+
+
+class RecordingLLM(FakeLLM):
+    """FakeLLM that keeps every prompt it is sent"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prompts = []
+
+    def create(self, model, messages, *args, **kwargs):
+        with self._lock:
+            self.prompts.append(messages[-1]["content"])
+        return super().create(model, messages, *args, **kwargs)
+
+
+def serve(fake: FakeLLM, host: str = "127.0.0.1", port: int = 8001):
+    """Serve `fake` as an OpenAI-compatible /v1/chat/completions endpoint"""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_POST(self):
+            if self.path.rstrip("/") != "/v1/chat/completions":
+                return self._json(404, {"error": {"message": "not found"}})
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            try:
+                response = fake.create(request["model"], request["messages"], request.get("max_tokens", 800),
+                                       request.get("temperature", 0.7), stream=request.get("stream", False),
+                                       stream_options=request.get("stream_options"))
+            except FakeAPIError as e:
+                return self._json(e.status_code, {"error": {"message": str(e)}}, e.response.headers)
+            except APIConnectionError:
+                # Drop the connection, as a network failure would
+                self.close_connection = True
+                return
+
+            completion = {"id": "fake", "object": "chat.completion", "created": int(time.time()),
+                          "model": request["model"]}
+            if not request.get("stream"):
+                return self._json(200, {**completion, "choices": [
+                    {"index": 0, "finish_reason": "stop",
+                     "message": {"role": "assistant", "content": response.choices[0].message.content}}],
+                    "usage": vars(response.usage)})
+
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for chunk in response:
+                data = {**completion, "object": "chat.completion.chunk",
+                        "choices": [{"index": 0, "delta": {"content": c.delta.content}} for c in chunk.choices]}
+                if chunk.usage:
+                    data["usage"] = vars(chunk.usage)
+                self._chunk(f"data: {json.dumps(data)}\n\n")
+            self._chunk("data: [DONE]\n\n")
+            self._chunk("")
+
+        def _json(self, status, body, headers=None):
+            payload = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def _chunk(self, text):
+            data = text.encode()
+            self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+            self.wfile.flush()
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the fake LLM as a local OpenAI-compatible server")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("serve")
+    p.add_argument("--host", default="127.0.0.1")
+    p.add_argument("--port", type=int, default=8001)
+    p.add_argument("--latency", type=float, default=0.5, help="seconds to first token")
+    p.add_argument("--latency-dist", choices=["fixed", "uniform", "lognormal"], default="fixed")
+    p.add_argument("--tokens-per-second", type=float, default=50)
+    p.add_argument("--error-rate", type=float, default=0.0)
+    p.add_argument("--errors", default="500,429", help="comma-separated status codes and/or 'connection'")
+    args = parser.parse_args()
+
+    fake = FakeLLM(args.latency, args.latency_dist, args.tokens_per_second, error_rate=args.error_rate,
+                   errors=[e if e == "connection" else int(e) for e in args.errors.split(",")])
+    server = serve(fake, args.host, args.port)
+    print(f"Fake LLM listening on http://{args.host}:{args.port}/v1 (set LLM_BASE_URL to this)")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
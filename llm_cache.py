@@ -0,0 +1,132 @@
+import hashlib
+import json
+import threading
+import time
+from concurrent.futures import Future
+
+from SQLiteState import state
+
+
+class LLMCache:
+    """SQLite-backed cache of LLM responses with a TTL and LRU eviction"""
+
+    def __init__(self, db, ttl=7 * 24 * 3600, max_entries=2000):
+        self.db = db
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._stats_lock = threading.Lock()
+        self.db.on_ready(self._create_tables)
+
+    def _create_tables(self):
+        with self.db.transaction() as conn:
+            conn.execute('''CREATE TABLE IF NOT EXISTS llm_cache (
+                key TEXT PRIMARY KEY,
+                response TEXT,
+                created_at REAL,
+                last_used REAL
+            )''')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_llm_cache_last_used ON llm_cache (last_used)')
+
+    @staticmethod
+    def make_key(model, prompt, max_tokens, temperature):
+        raw = json.dumps([model, prompt, max_tokens, temperature])
+        return hashlib.sha256(raw.encode()).hexdigest()
+
+    def get(self, key):
+        """Cached response for key, or None on a miss"""
+        now = time.time()
+        try:
+            with self.db.connection() as conn:
+                row = conn.execute('SELECT response, created_at FROM llm_cache WHERE key = ?',
+                                   (key,)).fetchone()
+            if row and now - row['created_at'] < self.ttl:
+                with self.db.transaction() as conn:
+                    conn.execute('UPDATE llm_cache SET last_used = ? WHERE key = ?', (now, key))
+                self._count(hit=True)
+                return row['response']
+            if row:
+                with self.db.transaction() as conn:
+                    conn.execute('DELETE FROM llm_cache WHERE key = ?', (key,))
+        except Exception as e:
+            print(f"Error reading LLM cache: {e}")
+        self._count(hit=False)
+        return None
+
+    def put(self, key, response):
+        """Store a response; error responses are never cached"""
+        if not response or response.startswith("Error"):
+            return
+        now = time.time()
+        try:
+            with self.db.transaction() as conn:
+                conn.execute('INSERT OR REPLACE INTO llm_cache VALUES (?, ?, ?, ?)',
+                             (key, response, now, now))
+                count = conn.execute('SELECT COUNT(*) FROM llm_cache').fetchone()[0]
+                if count > self.max_entries:
+                    conn.execute('''DELETE FROM llm_cache WHERE key IN (
+                                        SELECT key FROM llm_cache ORDER BY last_used LIMIT ?)''',
+                                 (count - self.max_entries,))
+        except Exception as e:
+            print(f"Error writing LLM cache: {e}")
+
+    def clear(self):
+        with self.db.transaction() as conn:
+            conn.execute('DELETE FROM llm_cache')
+
+    def _count(self, hit):
+        with self._stats_lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def stats(self):
+        with self.db.connection() as conn:
+            entries = conn.execute('SELECT COUNT(*) FROM llm_cache').fetchone()[0]
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "entries": entries,
+                "hit_rate": self.hits / total if total else 0.0}
+
+
+class SingleFlight:
+    """Coalesces concurrent calls that share a key: while one is running,
+    later callers wait for its result instead of making their own call"""
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.executed = 0
+        self.merged = 0
+
+    def do(self, key, fn):
+        """(result, shared) of fn(); shared is True if another caller's result was reused"""
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+                self.executed += 1
+            else:
+                self.merged += 1
+        if not leader:
+            return future.result(), True
+
+        try:
+            result = fn()
+            future.set_result(result)
+            return result, False
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+    def stats(self):
+        return {"executed": self.executed, "merged": self.merged, "in_flight": len(self._calls)}
+
+
+llm_cache = LLMCache(state)
+single_flight = SingleFlight()
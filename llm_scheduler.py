@@ -0,0 +1,193 @@
+import heapq
+import itertools
+import random
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+INTERACTIVE = 0
+BACKGROUND = 1
+
+_priority = ContextVar("llm_priority", default=INTERACTIVE)
+
+
+class LLMError(Exception):
+    """An LLM call that failed, after retries where retrying made sense"""
+
+    def __init__(self, message: str, status: int = None):
+        super().__init__(message)
+        self.status = status
+
+
+@contextmanager
+def priority(lane: int):
+    """Run the enclosed LLM calls in the given lane (INTERACTIVE or BACKGROUND)"""
+    token = _priority.set(lane)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def _status(error):
+    return getattr(error, "status_code", None)
+
+
+def _retry_after(error):
+    """Seconds from a Retry-After header, if the error carries one"""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+def _retryable(error):
+    status = _status(error)
+    if status is None:
+        # Connection errors and timeouts carry no status
+        return type(error).__name__ in ("APIConnectionError", "APITimeoutError")
+    return status == 429 or status >= 500
+
+
+class LLMScheduler:
+    """Shared gate for every LLM request.
+
+    Limits requests to `rate` per second (bursting to `burst`) and to
+    `max_in_flight` at once, lets INTERACTIVE callers ahead of BACKGROUND
+    ones, and retries 429/5xx/connection errors with jittered exponential
+    backoff, honoring Retry-After.
+    """
+
+    # OpenRouter's free tier allows 20 requests a minute
+    def __init__(self, rate=20 / 60, burst=5, max_in_flight=4, max_retries=4, base_delay=1.0, max_delay=30.0):
+        self.rate = rate
+        self.burst = burst
+        self.max_in_flight = max_in_flight
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+        self._cond = threading.Condition()
+        self._waiting = []
+        self._tickets = itertools.count()
+        self._in_flight = 0
+
+        self._bucket_lock = threading.Lock()
+        self._tokens = float(burst)
+        self._refilled = time.monotonic()
+        self._paused_until = 0.0
+
+        self.stats = {"calls": 0, "retries": 0, "failures": 0}
+
+    def run(self, fn, hold=False):
+        """Call fn() under the rate limit and concurrency cap, retrying transient
+        failures; raises LLMError once it gives up.
+
+        With hold, fn opens a stream: the in-flight slot stays taken until the
+        returned iterator is used up or closed, so generations count against
+        max_in_flight for as long as they run.
+        """
+        lane = _priority.get()
+        attempt = 0
+        while True:
+            self._acquire(lane)
+            held = False
+            try:
+                self._take_token()
+                self._count("calls")
+                result = fn()
+                if hold:
+                    result, held = HeldStream(result, self._release), True
+                return result
+            except Exception as e:
+                error = e
+            finally:
+                if not held:
+                    self._release()
+
+            if attempt >= self.max_retries or not _retryable(error):
+                self._count("failures")
+                raise LLMError(str(error), _status(error)) from error
+
+            delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+            retry_after = _retry_after(error)
+            if retry_after is not None:
+                delay = max(delay, retry_after)
+                # The server asked everyone to back off, not just this call
+                with self._bucket_lock:
+                    self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+            attempt += 1
+            self._count("retries")
+            time.sleep(delay)
+
+    def _count(self, name):
+        with self._bucket_lock:
+            self.stats[name] += 1
+
+    def _acquire(self, lane):
+        with self._cond:
+            ticket = (lane, next(self._tickets))
+            heapq.heappush(self._waiting, ticket)
+            while self._in_flight >= self.max_in_flight or self._waiting[0] != ticket:
+                self._cond.wait()
+            heapq.heappop(self._waiting)
+            self._in_flight += 1
+            self._cond.notify_all()
+
+    def _release(self):
+        with self._cond:
+            self._in_flight -= 1
+            self._cond.notify_all()
+
+    def _take_token(self):
+        """Token bucket: block until a request may be sent"""
+        while True:
+            with self._bucket_lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._refilled) * self.rate)
+                self._refilled = now
+                wait = self._paused_until - now
+                if wait <= 0 and self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = max(wait, (1 - self._tokens) / self.rate)
+            time.sleep(wait)
+
+
+class HeldStream:
+    """Iterator over a stream that calls release() once, when it is used up or closed"""
+
+    def __init__(self, stream, release):
+        self._stream = stream
+        self._iter = iter(stream)
+        self._release = release
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            return next(self._iter)
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self):
+        release, self._release = self._release, None
+        if release is None:
+            return
+        try:
+            close = getattr(self._stream, "close", None)
+            if close:
+                close()
+        finally:
+            release()
+
+    def __del__(self):
+        self.close()
+
+
+scheduler = LLMScheduler()
@@ -0,0 +1,138 @@
+"""Timing spans for agent operations.
+
+Every span is a name, a duration and a few numbers (tokens, cost, batch
+size...), kept in a fixed-size ring buffer so memory stays flat however
+long the app runs. `summary` gives p50/p95/p99 per operation for the
+Performance tab, and `prometheus` the same in the Prometheus text format.
+
+    with metrics.span("file.read", cached=False) as span:
+        ...
+        span["chars"] = len(text)
+"""
+import functools
+import time
+from collections import deque
+from contextlib import contextmanager
+from pathlib import Path
+
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+class Metrics:
+    def __init__(self, capacity=20000):
+        self._spans = deque(maxlen=capacity)
+
+    def record(self, name, seconds, **values):
+        """Add a finished span"""
+        # deque.append is atomic, so recording needs no lock
+        self._spans.append((name, time.time(), seconds, values))
+
+    @contextmanager
+    def span(self, name, **values):
+        """Time the enclosed block; numbers put in the yielded dict are stored with it.
+        A block that raises is recorded with error=1."""
+        start = time.perf_counter()
+        try:
+            yield values
+        except BaseException:
+            values["error"] = 1
+            raise
+        finally:
+            self.record(name, time.perf_counter() - start, **values)
+
+    def timed(self, name):
+        """Decorator: a span around every call"""
+        def decorate(fn):
+            # Spelled out rather than using span(): this wraps hot SQLite calls
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    result = fn(*args, **kwargs)
+                except BaseException:
+                    self._spans.append((name, time.time(), time.perf_counter() - start, {"error": 1}))
+                    raise
+                self._spans.append((name, time.time(), time.perf_counter() - start, {}))
+                return result
+            return wrapper
+        return decorate
+
+    def spans(self, name=None, since=None):
+        """Recorded spans, oldest first, as (name, wall time, seconds, values)"""
+        while True:
+            try:
+                spans = list(self._spans)
+                break
+            except RuntimeError:
+                # Appended to while being copied; try again
+                continue
+        return [s for s in spans if (name is None or s[0] == name) and (since is None or s[1] >= since)]
+
+    def clear(self):
+        self._spans.clear()
+
+    def summary(self, since=None):
+        """Per operation: count, errors, mean and p50/p95/p99 seconds, and the
+        sum of every other number recorded with it"""
+        grouped = {}
+        for name, _, seconds, values in self.spans(since=since):
+            group = grouped.setdefault(name, {"seconds": [], "totals": {}})
+            group["seconds"].append(seconds)
+            for key, value in values.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    group["totals"][key] = group["totals"].get(key, 0) + value
+
+        summary = {}
+        for name, group in sorted(grouped.items()):
+            samples = sorted(group["seconds"])
+            row = {"count": len(samples), "errors": group["totals"].pop("error", 0),
+                   "mean": sum(samples) / len(samples), "sum": sum(samples)}
+            for q in QUANTILES:
+                row[f"p{round(q * 100)}"] = _percentile(samples, q)
+            row.update(group["totals"])
+            summary[name] = row
+        return summary
+
+    def prometheus(self, prefix="study"):
+        """Summary per operation in the Prometheus text exposition format"""
+        summary = self.summary()
+        lines = [f"# HELP {prefix}_operation_seconds Duration of agent operations",
+                 f"# TYPE {prefix}_operation_seconds summary"]
+        for name, row in summary.items():
+            label = f'operation="{name}"'
+            for q in QUANTILES:
+                lines.append(f'{prefix}_operation_seconds{{{label},quantile="{q}"}} {row[f"p{round(q * 100)}"]:.6f}')
+            lines.append(f"{prefix}_operation_seconds_sum{{{label}}} {row['sum']:.6f}")
+            lines.append(f"{prefix}_operation_seconds_count{{{label}}} {row['count']}")
+
+        # Totals cover the spans still in the buffer, so they can fall: gauges, not counters
+        lines += [f"# HELP {prefix}_operation_errors Operations that raised",
+                  f"# TYPE {prefix}_operation_errors gauge"]
+        lines += [f'{prefix}_operation_errors{{operation="{name}"}} {row["errors"]}'
+                  for name, row in summary.items()]
+
+        for key, help_text in (("prompt_tokens", "Prompt tokens sent"),
+                               ("completion_tokens", "Completion tokens received"),
+                               ("cost_usd", "Estimated LLM cost in US dollars")):
+            rows = [(name, row[key]) for name, row in summary.items() if key in row]
+            if rows:
+                lines += [f"# HELP {prefix}_{key} {help_text}", f"# TYPE {prefix}_{key} gauge"]
+                lines += [f'{prefix}_{key}{{operation="{name}"}} {value}' for name, value in rows]
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path="metrics.prom"):
+        """Write `prometheus()` to path atomically, e.g. for node_exporter's textfile collector"""
+        path = Path(path)
+        tmp = path.with_suffix(path.suffix + ".tmp")
+        tmp.write_text(self.prometheus(), encoding="utf-8")
+        tmp.replace(path)
+        return path
+
+
+def _percentile(samples, q):
+    """Nearest-rank percentile of sorted samples"""
+    return samples[min(len(samples) - 1, max(0, round(q * len(samples)) - 1))]
+
+
+# Global metrics
+metrics = Metrics()
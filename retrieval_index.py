@@ -0,0 +1,184 @@
+import math
+import re
+import threading
+import zlib
+from array import array
+from collections import Counter, defaultdict
+
+from chunking import chunk_text, estimate_tokens
+from SQLiteState import state
+
+STOPWORDS = frozenset("""a an and are as at be by for from has have in is it its of on or that the this
+to was were will with you your i we they he she not but if then so than into about over""".split())
+
+
+def tokenize(text: str) -> list:
+    return [t for t in re.findall(r"\w+", text.lower()) if t not in STOPWORDS and len(t) > 1]
+
+
+class BM25Index:
+    """In-memory BM25 over text chunks.
+
+    New chunks are appended to compact per-term arrays and merged into
+    NumPy posting arrays on the next search, so scoring a query is a few
+    vectorized adds over the postings of its terms.
+    """
+
+    def __init__(self, k1: float = 1.2, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.chunks = []
+        self._doc_len = array('i')
+        self._pending = defaultdict(lambda: (array('i'), array('i')))
+        self._postings = {}
+        # NumPy is imported on the first search, not when the app starts
+        self._norm = ()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.chunks)
+
+    def add(self, chunk: dict):
+        """Index a chunk: a dict with at least a "text" key"""
+        counts = Counter(tokenize(chunk["text"]))
+        with self._lock:
+            doc = len(self.chunks)
+            self.chunks.append(chunk)
+            self._doc_len.append(sum(counts.values()))
+            for term, tf in counts.items():
+                ids, tfs = self._pending[term]
+                ids.append(doc)
+                tfs.append(tf)
+
+    def _freeze(self):
+        """Merge pending postings into the NumPy arrays and refresh length norms"""
+        if len(self._norm) == len(self.chunks):
+            return
+        import numpy as np
+        for term, (ids, tfs) in self._pending.items():
+            new_ids = np.frombuffer(ids, np.int32)
+            new_tfs = np.frombuffer(tfs, np.int32).astype(np.float32)
+            if term in self._postings:
+                old_ids, old_tfs = self._postings[term]
+                new_ids, new_tfs = np.concatenate([old_ids, new_ids]), np.concatenate([old_tfs, new_tfs])
+            else:
+                new_ids = new_ids.copy()
+            self._postings[term] = (new_ids, new_tfs)
+        self._pending.clear()
+
+        doc_len = np.frombuffer(self._doc_len, np.int32).astype(np.float32)
+        avgdl = max(float(doc_len.mean()), 1.0)
+        self._norm = self.k1 * (1 - self.b + self.b * doc_len / avgdl)
+
+    def search(self, query: str, k: int = 10) -> list:
+        """Top k (score, chunk) pairs for query, best first"""
+        terms = set(tokenize(query))
+        with self._lock:
+            self._freeze()
+            n = len(self.chunks)
+            if not n or not terms:
+                return []
+            import numpy as np
+            scores = np.zeros(n, np.float32)
+            for term in terms:
+                if term not in self._postings:
+                    continue
+                ids, tfs = self._postings[term]
+                idf = math.log(1 + (n - len(ids) + 0.5) / (len(ids) + 0.5))
+                scores[ids] += idf * tfs * (self.k1 + 1) / (tfs + self._norm[ids])
+
+            k = min(k, n)
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top])]
+            return [(float(scores[i]), self.chunks[i]) for i in top if scores[i] > 0]
+
+
+class Retriever:
+    """Per-user retrieval over chunks of uploaded files and generated artifacts.
+
+    Chunks are stored in SQLite; each user's BM25Index is built in memory on
+    first use and, before every search, catches up on chunks stored since,
+    including those written by other processes such as the ingest CLI.
+    """
+
+    def __init__(self, db, chunk_tokens: int = 300, chunk_overlap: int = 30):
+        self.db = db
+        self.chunk_tokens = chunk_tokens
+        self.chunk_overlap = chunk_overlap
+        # user_id -> (BM25Index, id of the last chunk it holds)
+        self._indexes = {}
+        self._lock = threading.Lock()
+        self.db.on_ready(self._create_tables)
+
+    def _create_tables(self):
+        # Drop indexes loaded from a database state.use() switched away from
+        self._indexes = {}
+        with self.db.transaction() as conn:
+            created = not conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'retrieval_chunks'").fetchone()
+            conn.execute('''CREATE TABLE IF NOT EXISTS retrieval_chunks (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id TEXT NOT NULL,
+                doc TEXT NOT NULL,
+                source TEXT,
+                kind TEXT,
+                text TEXT
+            )''')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_retrieval_chunks_user_doc ON retrieval_chunks (user_id, doc)')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_retrieval_chunks_user_id ON retrieval_chunks (user_id, id)')
+        if created:
+            self._backfill()
+
+    def _backfill(self):
+        """Index the artifacts saved before retrieval existed"""
+        with self.db.connection() as conn:
+            rows = conn.execute('''SELECT c.user_id, c.id, c.filename, c.type, b.body
+                                   FROM content c JOIN content_bodies b USING (id)''').fetchall()
+        for row in rows:
+            self.add_document(row['user_id'], row['id'], row['filename'], row['type'],
+                              zlib.decompress(row['body']).decode('utf-8'))
+
+    def add_document(self, user_id: str, doc: str, source: str, kind: str, text: str):
+        """Chunk and index a document once per (user, doc) key; True if it was added now"""
+        if not user_id or not text:
+            return False
+        chunks = [{"source": source, "kind": kind, "text": chunk}
+                  for chunk in chunk_text(text, self.chunk_tokens, self.chunk_overlap) if chunk.strip()]
+        # The next search picks the new rows up into the in-memory index
+        try:
+            with self.db.transaction() as conn:
+                if conn.execute('SELECT 1 FROM retrieval_chunks WHERE user_id = ? AND doc = ? LIMIT 1',
+                                (user_id, doc)).fetchone():
+                    return False
+                conn.executemany('''INSERT INTO retrieval_chunks (user_id, doc, source, kind, text)
+                                    VALUES (?, ?, ?, ?, ?)''',
+                                 [(user_id, doc, c["source"], c["kind"], c["text"]) for c in chunks])
+        except Exception as e:
+            print(f"Error indexing {source} for retrieval: {e}")
+            return False
+        return True
+
+    def search(self, user_id: str, query: str, token_budget: int = 400, k: int = 20) -> list:
+        """Most relevant chunks for query, best first, until token_budget is used up"""
+        selected, used = [], 0
+        for score, chunk in self._index(user_id).search(query, k):
+            tokens = estimate_tokens(chunk["text"])
+            if used + tokens > token_budget:
+                continue
+            selected.append({**chunk, "score": score})
+            used += tokens
+        return selected
+
+    def _index(self, user_id: str) -> BM25Index:
+        """The user's index, after adding the chunks stored since it was last read"""
+        with self._lock:
+            index, last_id = self._indexes.get(user_id) or (BM25Index(), 0)
+            with self.db.connection() as conn:
+                for row in conn.execute('''SELECT id, source, kind, text FROM retrieval_chunks
+                                           WHERE user_id = ? AND id > ? ORDER BY id''', (user_id, last_id)):
+                    last_id = row['id']
+                    index.add({"source": row['source'], "kind": row['kind'], "text": row['text']})
+            self._indexes[user_id] = (index, last_id)
+            return index
+
+
+retriever = Retriever(state)
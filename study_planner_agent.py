@@ -1,28 +1,36 @@
+from pathlib import Path
+
 from base_agent import BaseAgent
+from llm_scheduler import LLMError
+from metrics import metrics
+from retrieval_index import retriever
 from SQLiteState import *
 
 
 class StudyPlannerAgent(BaseAgent):
-    def __init__(self):
-        super().__init__("StudyPlanner")
+    def __init__(self, client=None):
+        super().__init__("StudyPlanner", client=client)
         self.content_processor = None
 
     def register_content_processor(self, content_processor):
         self.content_processor = content_processor
         print(" ContentProcessor connected to StudyPlanner")
 
-    def create_plan(self, subject: str, hours: str, deadline: str, focus: str, goals: str):
+    def create_plan(self, subject: str, hours: str, deadline: str, focus: str, goals: str, on_token=None,
+                    library_context: str = ""):
         """Create study plan with user context from sql"""
 
         # Get user context
-        user = state.get(f"user:{self.current_user_id}", {}) if self.current_user_id else {}
-        user_sessions = state.get_list(f"sessions:{self.current_user_id}", 5) if self.current_user_id else []
+        user = get_user(self.current_user_id) if self.current_user_id else {}
+        user_sessions = get_user_sessions(self.current_user_id, 5) if self.current_user_id else []
 
         # Build context from previous sessions
         session_context = ""
         if user_sessions:
             recent_subjects = [s.get('subject', '') for s in user_sessions]
             session_context = f"\nRecent study subjects: {', '.join(recent_subjects)}"
+        if library_context:
+            session_context += f"\n\nRelevant material from the user's library:\n{library_context}"
 
         prompt = f"""Create a personalized study plan for {subject}.
 
@@ -44,17 +52,17 @@ Create a detailed study plan with:
 
 Make it personalized and realistic."""
 
-        result = self.call_ai(prompt, 1000)
+        result = self.call_ai(prompt, 1000, on_token)
 
         # Save plan to sql
         if self.current_user_id:
-            save_content(self.current_user_id, f"Study Plan - {subject}", "plan", result)
+            self.save_result(f"Study Plan - {subject}", "plan", result)
 
         return result
 
     def get_methods(self, subject: str, topic: str, learning_style: str):
         """Get study methods with user context"""
-        user = state.get(f"user:{self.current_user_id}", {}) if self.current_user_id else {}
+        user = get_user(self.current_user_id) if self.current_user_id else {}
 
         prompt = f"""Recommend study methods for {subject}, topic: {topic}
 
@@ -71,55 +79,63 @@ Make it practical and actionable."""
 
         return self.call_ai(prompt, 600)
 
+    @metrics.timed("plan.comprehensive")
     def comprehensive_planning(self, subject: str, hours: str, deadline: str, focus: str, goals: str,
-                               files: list = None):
+                               files: list = None, on_token=None, filenames: list = None):
         print(f"\n Comprehensive planning for {subject}")
 
         results = []
 
+        library_context = ""
         if self.current_user_id:
-            user_content = state.get_list(f"user_content:{self.current_user_id}", 10)
-            relevant_content = [item for item in user_content
-                                if item['type'] in ['summary', 'notes', 'analysis', 'questions']]
-
-            if relevant_content:
-                content_insights = []
-                for item in relevant_content[:3]:
-                    content_insights.append(f"{item['type'].upper()} ({item['filename']}): {item['content'][:300]}...")
-
-                if content_insights:
-                    results.append("EXISTING PROCESSED CONTENT:\n" + "\n\n".join(content_insights))
-
+            # Chunks from past uploads and artifacts that best match this plan, within a fixed token budget
+            with metrics.span("plan.retrieval"):
+                passages = retriever.search(self.current_user_id, f"{subject} {focus} {goals}", token_budget=400)
+            if passages:
+                library_context = "\n\n".join(f"{p['kind'].upper()} ({p['source']}): {p['text']}"
+                                                for p in passages)
+                results.append("EXISTING PROCESSED CONTENT:\n" + library_context)
+
+        # File analyses and the plan itself don't depend on each other: the analyses run
+        # on the content processor's pool while the plan is streamed from this thread
+        analyses = []
         if files and self.content_processor:
             self.send_message("ContentProcessor", "Process files for comprehensive planning")
-            file_insights = []
-
-            for file_path in files:
-                try:
-                    content = self.content_processor.read_file(file_path)
-                    if not content.startswith("Error"):
-                        insight = self.content_processor.analyze_for_planning(content, file_path)
-                        file_insights.append(f"📄 {file_path}: {insight}")
-
-                        # Save file analysis to sql
-                        if self.current_user_id:
-                            save_content(self.current_user_id, file_path, "analysis", insight)
-
-                except Exception as e:
-                    continue
-
-            if file_insights:
-                results.append("FILE ANALYSIS:\n" + "\n\n".join(file_insights))
+            names = filenames or [Path(file_path).name for file_path in files]
+            if len(files) > 1:
+                # Extract every file up front in parallel; the analyses below then read from the cache
+                with metrics.span("plan.extraction", files=len(files)):
+                    self.content_processor.read_files(files)
+            analyses = [(name, self.content_processor.analyze_file(file_path, name, wait=False))
+                        for file_path, name in zip(files, names)]
 
         self.send_message("ContentProcessor", "Creating enhanced plan with file context")
-        plan = self.create_plan(subject, hours, deadline, focus, goals)
+        with metrics.span("plan.create"):
+            plan = self.create_plan(subject, hours, deadline, focus, goals, on_token, library_context)
+
+        file_insights = []
+        for name, future in analyses:
+            try:
+                # Only the part of the analyses that outlasted the plan
+                with metrics.span("plan.analysis_wait"):
+                    insight = future.result()
+            except LLMError as e:
+                print(f"Analysis of {name} failed: {e}")
+                continue
+            # Files that couldn't be read come back as their error message
+            if not insight.startswith(("Error", "Unsupported")):
+                file_insights.append(f"📄 {name}: {insight}")
+        if file_insights:
+            results.append("FILE ANALYSIS:\n" + "\n\n".join(file_insights))
+
         results.append(f"STUDY PLAN:\n{plan}")
 
-        recommendations = self.get_recommendations(subject, plan)
+        with metrics.span("plan.recommendations"):
+            recommendations = self.get_recommendations(subject, plan)
         results.append(f"RECOMMENDATIONS:\n{recommendations}")
 
-        user_sessions = state.get_list(f"sessions:{self.current_user_id}", 5) if self.current_user_id else []
-        user_content = state.get_list(f"user_content:{self.current_user_id}", 5) if self.current_user_id else []
+        user_sessions = get_user_sessions(self.current_user_id, 5) if self.current_user_id else []
+        user_content = get_user_content(self.current_user_id, 5) if self.current_user_id else []
 
         summary = f"""SESSION SUMMARY:
 • Files Processed: {len(files) if files else 0}
@@ -132,8 +148,8 @@ Make it practical and actionable."""
         return "\n\n" + "=" * 60 + "\n\n".join(results)
 
     def get_recommendations(self, subject: str, plan: str):
-        user = state.get(f"user:{self.current_user_id}", {}) if self.current_user_id else {}
-        sessions = state.get_list(f"sessions:{self.current_user_id}", 10) if self.current_user_id else []
+        user = get_user(self.current_user_id) if self.current_user_id else {}
+        sessions = get_user_sessions(self.current_user_id, 10) if self.current_user_id else []
 
         # Analyze user patterns
         session_subjects = [s.get('subject', '') for s in sessions]
@@ -0,0 +1,75 @@
+"""Many users planning at once on one shared agent must not see each other's data.
+
+Runs against a throwaway database and FakeLLM:
+
+    python -m pytest test_user_context.py
+"""
+import re
+import tempfile
+import threading
+import unittest
+from pathlib import Path
+
+from base_agent import user_context
+from llm_backends import RecordingLLM
+from llm_scheduler import scheduler
+from SQLiteState import (SQLiteState, end_session, get_session_activities, get_user_content, start_session,
+                         state, update_user)
+from study_planner_agent import StudyPlannerAgent
+
+USERS = 8
+PLANS = 3
+
+
+class UserContextTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        previous = state.use(lambda: SQLiteState(Path(tmp.name) / "test.db", write_mode="behind"))
+        self.addCleanup(state.use, previous)
+        rate, burst = scheduler.rate, scheduler.burst
+        scheduler.rate = scheduler.burst = 1000
+        self.addCleanup(setattr, scheduler, "rate", rate)
+        self.addCleanup(setattr, scheduler, "burst", burst)
+
+    def test_concurrent_users_stay_apart(self):
+        llm = RecordingLLM(0.02)
+        planner = StudyPlannerAgent(llm)
+        planner.use_cache = False
+        barrier, errors = threading.Barrier(USERS), []
+
+        def plan(i):
+            user_id = f"user-{i}"
+            update_user(user_id, f"name{i}", f"style-{i}")
+            barrier.wait()
+            for _ in range(PLANS):
+                session_id = start_session(user_id, f"Subject {i}")
+                with user_context(user_id, session_id):
+                    planner.create_plan(f"Subject {i}", "5 hours", "next week", "all", "pass")
+                end_session(session_id)
+                activities = get_session_activities(session_id)
+                if len(activities) != 1:
+                    errors.append(f"session of {user_id} logged {len(activities)} activities")
+
+        threads = [threading.Thread(target=plan, args=(i,)) for i in range(USERS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+        self.assertEqual(len(llm.prompts), USERS * PLANS)
+        for prompt in llm.prompts:
+            subject = re.search(r"study plan for Subject (\d+)", prompt).group(1)
+            self.assertEqual(set(re.findall(r"Learning Style: style-(\d+)", prompt)), {subject})
+            recent = re.search(r"Recent study subjects: (.*)", prompt)
+            if recent:
+                self.assertLessEqual(set(re.findall(r"Subject (\d+)", recent.group(1))), {subject})
+
+        for i in range(USERS):
+            filenames = {item["filename"] for item in get_user_content(f"user-{i}", 1000)}
+            self.assertEqual(filenames, {f"Study Plan - Subject {i}"})
+
+
+if __name__ == "__main__":
+    unittest.main()